@@ -0,0 +1,24 @@
+"""
+gunicorn для потока событий заказов (orders.views.orders_events, SSE) - отдельно от API:
+
+    gunicorn -c /code/terminal/gunicorn_events.py su.wsgi
+
+Соединение SSE держится минутами. На синхронном воркере API оно занимало бы воркер целиком,
+на gevent - это гринлет, один процесс держит сотни потоков. Прокси направляет сюда только путь
+потока событий (без буферизации, proxy_buffering off), остальное - на воркеры API (сервис terminal).
+"""
+import os
+
+bind = '0.0.0.0:%s' % os.environ.get('ORDERS_EVENTS_PORT', '8001')
+chdir = '/code/terminal'
+worker_class = 'gevent'
+workers = int(os.environ.get('ORDERS_EVENTS_WORKERS', '2'))
+worker_connections = int(os.environ.get('ORDERS_EVENTS_CONNECTIONS', '1000'))
+# по нему orders_events понимает, что запущен здесь, а не на воркерах API
+raw_env = ['ORDERS_EVENTS_WORKER=1']
+
+
+def post_fork(server, worker):
+    # запросы psycopg2 (авторизация, права) не должны блокировать остальные гринлеты воркера
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
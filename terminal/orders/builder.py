@@ -0,0 +1,139 @@
+from django.utils import timezone
+
+from orders.models import Order, OrderCustomField, OrderCustomFieldValue, OrderDraft, OrderInvoice, OrderStatusLog
+from orders.payload import dict_value
+from orders.pricing import orders_prices
+from services.models import Service
+
+
+def load_services(services_data):
+    """ Услуги для строк заказа одним запросом, в порядке строк. Нет услуги - Service.DoesNotExist """
+    services = Service.objects.in_bulk({int(line.get('id')) for line in services_data})
+    result = []
+    for line in services_data:
+        service = services.get(int(line.get('id')))
+        if service is None:
+            raise Service.DoesNotExist('Service id=%s' % line.get('id'))
+        result.append(service)
+    return result
+
+
+def build_invoice(o, service, line):
+    if service.service_type_id == 1:
+        cost = service.cost
+        cost_signedup = service.cost_signedup
+    else:
+        cost = None
+        cost_signedup = None
+    # count приводится к float, как после сохранения, чтобы цену можно было считать по объекту в памяти
+    count = OrderInvoice._meta.get_field('count').to_python(line.get('count'))
+    return OrderInvoice(count=count, service=service, order=o, cost=cost, title=service.title,
+                        department_id=int(line.get('department_id')), cost_signedup=cost_signedup)
+
+
+def load_custom_fields(fields):
+    """ Поля для значений одним запросом. Нет поля или не указан id - OrderCustomField.DoesNotExist """
+    ids = [field.get('id') for field in fields]
+    if not all(ids):
+        raise OrderCustomField.DoesNotExist('OrderCustomField id is empty')
+    custom_fields = OrderCustomField.objects.select_related('field_type').in_bulk({int(i) for i in ids})
+    for i in ids:
+        if int(i) not in custom_fields:
+            raise OrderCustomField.DoesNotExist('OrderCustomField id=%s' % i)
+    return custom_fields
+
+
+def build_field_value(o, field, custom_fields):
+    # значение приводится к строке, как после сохранения в TextField
+    to_text = OrderCustomFieldValue._meta.get_field('value').to_python
+    return OrderCustomFieldValue(value=to_text(field.get('value')), value_json=dict_value(field.get('value')),
+                                 custom_field=custom_fields[int(field.get('id'))], order=o)
+
+
+def create_order(store, customer, user, phone, send_sms, dates, services_data, services, fields, custom_fields):
+    """
+    Новый заказ со строками, значениями полей, отделами, логом и черновиком - вызывается в транзакции.
+    Текст и цена считаются по объектам в памяти до записи, поэтому заказ пишется одним INSERT,
+    остальное - одним INSERT на таблицу (6 запросов, сколько бы ни было услуг и полей)
+    """
+    # дата создания ставится на заказ сразу - сигналу черновика пересчитывать нечего
+    o = Order(phone=phone, status_id=1, send_sms=send_sms, store=store, customer=customer,
+              created_at=timezone.now(), created_by=user)
+    invoices = [build_invoice(o, service, line) for service, line in zip(services, services_data)]
+    field_values = [build_field_value(o, field, custom_fields) for field in fields]
+    o.set_order_data(o.get_signedup_order_text(dates=dates, invoices=invoices, field_values=field_values))
+    o.cost = orders_prices([invoices])[0]
+    o.save()
+
+    # строки собирались до INSERT заказа - id проставляем переприсваиванием
+    for obj in invoices + field_values:
+        obj.order = o
+    OrderInvoice.objects.bulk_create(invoices)
+    OrderCustomFieldValue.objects.bulk_create(field_values)
+    # отделы прямо в промежуточную таблицу: add() перед вставкой еще читает существующие связи
+    Order.departments.through.objects.bulk_create([
+        Order.departments.through(order_id=o.id, clientstoredepartment_id=department_id)
+        for department_id in {int(line.get('department_id')) for line in services_data}
+    ])
+    OrderStatusLog.objects.create(order=o, status_id=1, created=o.created_at)
+    OrderDraft.objects.create(order=o, employee=user, created=o.created_at)
+    return o
+
+
+def sync_order_lines(o, services_data, services):
+    """
+    Приводит строки заказа к присланным: разница считается в памяти, затем один DELETE, один bulk_update
+    и один bulk_create. Строки определяются парой (услуга, отдел). Возвращает инвойсы заказа в порядке id
+    """
+    lines = {}
+    for service, line in zip(services, services_data):
+        lines[(service.id, int(line.get('department_id')))] = build_invoice(o, service, line)
+
+    existing = list(OrderInvoice.objects.filter(order=o).select_related('service').order_by('id'))
+    stale = [oi.id for oi in existing if (oi.service_id, oi.department_id) not in lines]
+    if stale:
+        OrderInvoice.objects.filter(id__in=stale).delete()
+
+    kept = [oi for oi in existing if (oi.service_id, oi.department_id) in lines]
+    for oi in kept:
+        new = lines[(oi.service_id, oi.department_id)]
+        oi.count = new.count
+        oi.cost = new.cost
+        oi.cost_signedup = new.cost_signedup
+    OrderInvoice.objects.bulk_update(kept, ['count', 'cost', 'cost_signedup'])
+
+    kept_keys = {(oi.service_id, oi.department_id) for oi in kept}
+    created = OrderInvoice.objects.bulk_create([new for key, new in lines.items() if key not in kept_keys])
+    o.departments.add(*{int(line.get('department_id')) for line in services_data})
+    return kept + created
+
+
+def sync_order_fields(o, fields, custom_fields):
+    """
+    То же для значений кастомных полей, строки определяются полем (custom_fields - из load_custom_fields).
+    Возвращает значения с загруженными полями
+    """
+    to_text = OrderCustomFieldValue._meta.get_field('value').to_python
+    submitted = {}
+    for field in fields:
+        submitted[int(field.get('id'))] = (to_text(field.get('value')), dict_value(field.get('value')))
+
+    existing = list(OrderCustomFieldValue.objects.filter(order=o).order_by('id'))
+    stale = [v.id for v in existing if v.custom_field_id not in submitted]
+    if stale:
+        OrderCustomFieldValue.objects.filter(id__in=stale).delete()
+
+    kept = [v for v in existing if v.id not in stale]
+    for v in kept:
+        v.value, v.value_json = submitted[v.custom_field_id]
+    OrderCustomFieldValue.objects.bulk_update(kept, ['value', 'value_json'])
+
+    kept_fields = {v.custom_field_id for v in kept}
+    created = OrderCustomFieldValue.objects.bulk_create([
+        OrderCustomFieldValue(value=value, value_json=value_json, custom_field_id=custom_field_id, order=o)
+        for custom_field_id, (value, value_json) in submitted.items() if custom_field_id not in kept_fields
+    ])
+    values = kept + created
+    for v in values:
+        v.custom_field = custom_fields.get(v.custom_field_id)
+    return values
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import uuid
+
+from django.core.cache import cache
+
+from orders.deferred import defer, run_pending
+
+# Поколение заказов магазина: меняется при любом изменении его заказов. Кеш ответов читается по ключу
+# с текущими поколениями, поэтому после записи старые ответы просто перестают находиться
+STORE_GENERATION_KEY = 'orders:generation:store:%s'
+# Общее поколение всех заказов, для списков без фильтра по магазинам
+GLOBAL_GENERATION_KEY = 'orders:generation:all'
+# Версия отдельного заказа, для карточки
+ORDER_VERSION_KEY = 'orders:generation:order:%s'
+ORDERS_VIEW_TIMEOUT = 60 * 10
+
+
+def _generations(keys):
+    values = cache.get_many(keys)
+    missing = [key for key in keys if key not in values]
+    for key in missing:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+    if missing:
+        values.update(cache.get_many(missing))
+    return [values.get(key) for key in keys]
+
+
+def store_generations(store_ids):
+    return _generations([STORE_GENERATION_KEY % store_id for store_id in store_ids])
+
+
+def global_generation():
+    return _generations([GLOBAL_GENERATION_KEY])[0]
+
+
+def order_version(order_id):
+    return _generations([ORDER_VERSION_KEY % order_id])[0]
+
+
+def _bump(store_ids, orders_id):
+    keys = [STORE_GENERATION_KEY % store_id for store_id in set(store_ids) if store_id] + [GLOBAL_GENERATION_KEY]
+    keys += [ORDER_VERSION_KEY % order_id for order_id in set(orders_id)]
+    cache.set_many({key: uuid.uuid4().hex for key in keys}, timeout=None)
+
+
+def _bump_pending(items):
+    from clients.models import ClientStore
+    from orders.models import Order
+    # даты заказов из логов пересчитываются тем же коммитом: новое поколение - только после них,
+    # иначе опрос между колбэками закеширует старые даты под новым ключом до конца TTL
+    run_pending('orders_log_dates')
+    store_ids = {i for kind, i in items if kind == 'store'}
+    orders_id = {i for kind, i in items if kind in ('order', 'order_store')}
+    lookup = [i for kind, i in items if kind == 'order_store']
+    if lookup:
+        store_ids.update(Order.objects.filter(id__in=lookup).values_list('store_id', flat=True).distinct())
+    departments_id = [i for kind, i in items if kind == 'department']
+    if departments_id:
+        # отдел виден в списках тех магазинов, в заказах которых он есть
+        store_ids.update(Order.objects.filter(departments__in=departments_id).values_list('store_id', flat=True).distinct())
+    clients_id = [i for kind, i in items if kind == 'client']
+    if clients_id:
+        store_ids.update(ClientStore.objects.filter(client_id__in=clients_id).values_list('id', flat=True))
+    _bump(store_ids, orders_id)
+
+
+def bump_stores(store_ids, orders_id=()):
+    """
+    Новые поколения магазинов (и версии заказов) - после коммита, иначе кеш успеет заполниться старыми данными.
+    Все изменения за транзакцию сводятся в один set_many
+    """
+    defer('orders_bump', _bump_pending, [('store', i) for i in store_ids] + [('order', i) for i in orders_id])
+
+
+def bump_orders(orders_id):
+    """ То же по id заказов, магазины ищутся после коммита (для удаляемых заказов - bump_stores) """
+    defer('orders_bump', _bump_pending, [('order_store', i) for i in orders_id if i])
+
+
+def bump_departments(departments_id):
+    """ Название отдела есть в списках заказов: новые поколения магазинов, где он встречается (ищутся после коммита) """
+    defer('orders_bump', _bump_pending, [('department', i) for i in departments_id if i])
+
+
+def bump_clients(clients_id):
+    """ То же для клиента: все его магазины """
+    defer('orders_bump', _bump_pending, [('client', i) for i in clients_id if i])
+
+
+def access_scope(access):
+    """ Кешированный ответ зависит только от прав юзера: пользователи с одинаковыми правами делят кеш """
+    return [access.is_terminal_man, sorted(access.department_ids), sorted(access.store_ids)]
+
+
+def _digest(*parts):
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def _params(query_params):
+    return sorted((key, query_params.getlist(key)) for key in query_params)
+
+
+def orders_view_cache_key(access, query_params, store_ids):
+    return 'orders:view:%s' % _digest(access_scope(access), _params(query_params), store_generations(store_ids))
+
+
+def orders_view_etag(cache_key):
+    """ Ключ кеша уже включает права, параметры и поколения магазинов - он же валидатор ответа """
+    return '"%s"' % cache_key.split(':')[-1]
+
+
+def orders_view_admin_etag(query_params):
+    return '"%s"' % _digest('admin', _params(query_params), global_generation())
+
+
+def order_card_etag(access, order_id, catalog_version):
+    # в карточке есть услуги и поля клиента, поэтому учитываем и версию каталога
+    return '"%s"' % _digest('card', access_scope(access), order_id, order_version(order_id), catalog_version)
+
+
+def not_modified(request, etag):
+    """ If-None-Match совпал с текущим ETag - можно отвечать 304, ничего не собирая """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    return header.strip() == '*' or etag in [t.strip().replace('W/', '', 1) for t in header.split(',')]
+
+
+def get_orders_view(key):
+    return cache.get(key)
+
+
+def set_orders_view(key, data):
+    cache.set(key, data, ORDERS_VIEW_TIMEOUT)
@@ -0,0 +1,19 @@
+from orders.models import Feedback, Order, OrderCustomFieldValue, OrderInvoice, OrderOutbox, OrderPublish, OrderStatusLog
+
+
+def load_order(order_id):
+    """
+    Заказ для карточки со всем, что ей нужно, за фиксированное число запросов (8), сколько бы ни было
+    услуг, полей и логов. Публикация и отзыв кладутся на объект, свойства заказа (publish, executor_id)
+    читают их без запросов; date, fio, publish_fio - поля заказа. card_outbox - последняя отправка в сайнап
+    """
+    o = Order.objects.select_related('status', 'store__client', 'store__city', 'created_by', 'publisher').prefetch_related(
+        'departments').get(id=order_id)
+    o._publish = OrderPublish.objects.filter(order=o).order_by('id').first()
+    o._feedback = Feedback.objects.filter(order=o).order_by('id').first()
+    o.card_invoices = list(OrderInvoice.objects.filter(order=o).select_related('service'))
+    o.card_field_values = list(OrderCustomFieldValue.objects.filter(order=o).select_related(
+        'custom_field__field_type').order_by('custom_field__index_number'))
+    o.card_logs = list(OrderStatusLog.objects.filter(order=o).select_related('status'))
+    o.card_outbox = OrderOutbox.objects.filter(order=o).order_by('-id').first()
+    return o
@@ -0,0 +1,46 @@
+import uuid
+
+from django.core.cache import cache
+
+# Версия каталога (услуги, отделы, кастомные поля) в Redis. Меняется сигналами при любом их изменении,
+# старые ключи просто перестают читаться и истекают сами
+CATALOG_VERSION_KEY = 'orders:catalog:version'
+CATALOG_TIMEOUT = 60 * 60 * 24
+
+
+def invalidate_catalog():
+    cache.set(CATALOG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def catalog_scope(user):
+    """
+    Администратор терминала, АМ и АСМ видят все отделы магазина - каталог общий для роли.
+    Остальным показываются только их отделы - каталог свой у каждого юзера
+    """
+    if user.is_terminal_man:
+        return 'terminal_man'
+    if user.is_am:
+        return 'am'
+    if user.is_acm:
+        return 'acm'
+    return 'user:%s' % user.id
+
+
+def catalog_key(store_id, user, department_id=None):
+    return 'orders:catalog:%s:%s:%s:%s' % (catalog_version(), store_id, catalog_scope(user), department_id or '')
+
+
+def get_catalog(store_id, user, department_id=None):
+    return cache.get(catalog_key(store_id, user, department_id))
+
+
+def set_catalog(store_id, user, department_id, data):
+    cache.set(catalog_key(store_id, user, department_id), data, CATALOG_TIMEOUT)
@@ -0,0 +1,68 @@
+import threading
+
+from django.db import transaction
+
+_local = threading.local()
+
+
+class _Batch:
+    """ Накопленные за транзакцию id и единственный зарегистрированный на коммит вызов """
+
+    def __init__(self, key, func):
+        self.key = key
+        self.func = func
+        self.items = set()
+        self.done = False
+
+    def __call__(self):
+        # может быть вызван раньше своей очереди (run_pending), тогда на коммите уже ничего не делает
+        if self.done:
+            return
+        self.done = True
+        pending = _pending()
+        if pending.get(self.key) is self:
+            del pending[self.key]
+        self.func(self.items)
+
+
+def _pending():
+    if not hasattr(_local, 'pending'):
+        _local.pending = {}
+    return _local.pending
+
+
+def _registered(connection, batch):
+    # после отката (транзакции или savepoint) Django выкидывает колбэк из run_on_commit - тогда копим заново
+    return any(entry[1] is batch for entry in connection.run_on_commit)
+
+
+def defer(name, func, items, using=None):
+    """
+    func(items) после коммита текущей транзакции. Все вызовы с одним name за транзакцию складываются
+    в одно множество и выполняются одним on_commit: десять сигналов по заказу - одна пересборка.
+    Вне транзакции - сразу
+    """
+    items = [i for i in items if i is not None]
+    if not items:
+        return
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        func(set(items))
+        return
+    key = (connection.alias, name)
+    batch = _pending().get(key)
+    if batch is None or not _registered(connection, batch):
+        batch = _pending()[key] = _Batch(key, func)
+        transaction.on_commit(batch, using=using)
+    batch.items.update(items)
+
+
+def run_pending(name, using=None):
+    """
+    Выполнить накопленное по name сейчас - для колбэков коммита, которым нужны его результаты.
+    Выполненная пачка снимается, поэтому ее колбэк на коммите ничего не делает, а новые defer копят следующую
+    """
+    connection = transaction.get_connection(using)
+    batch = _pending().get((connection.alias, name))
+    if batch is not None:
+        batch()
@@ -0,0 +1,108 @@
+import json
+import os
+import time
+import traceback
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+from rest_framework.renderers import BaseRenderer
+
+# События заказов магазина (смена статуса, заполненный отзыв) - Redis pub/sub, канал на магазин
+EVENTS_CHANNEL = 'orders:events:store:%s'
+# Комментарий-пинг, чтобы прокси не закрывали тихое соединение
+SSE_KEEPALIVE = 15
+# Соединение живет ограниченное время, EventSource переподключится сам через retry
+SSE_MAX_DURATION = 60 * 5
+SSE_RETRY_MS = 3000
+
+
+def events_worker():
+    """
+    Поток держит соединение минутами, поэтому отдается отдельным gunicorn на gevent-воркерах
+    (terminal/gunicorn_events.py, сервис terminal-events), а не воркерами API. Там выставлен ORDERS_EVENTS_WORKER=1;
+    локально (runserver, DEBUG) и в тестах - ORDERS_EVENTS_SYNC
+    """
+    return os.environ.get('ORDERS_EVENTS_WORKER') == '1' or getattr(settings, 'ORDERS_EVENTS_SYNC', settings.DEBUG)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """ Чтобы DRF не отвечал 406 на Accept: text/event-stream (поток отдается StreamingHttpResponse) """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, (str, bytes)):
+            return data
+        return json.dumps(data, cls=DjangoJSONEncoder)
+
+
+def _publish(orders_events):
+    from orders.models import Order
+    try:
+        orders = {o['id']: o for o in Order.objects.filter(id__in=orders_events).values('id', 'store_id')}
+        departments = {}
+        for order_id, department_id in Order.departments.through.objects.filter(
+                order_id__in=orders_events).values_list('order_id', 'clientstoredepartment_id'):
+            departments.setdefault(order_id, []).append(department_id)
+        conn = get_redis_connection('default')
+        for order_id, events in orders_events.items():
+            order = orders.get(order_id)
+            if not order or not order['store_id']:
+                continue
+            for event in events:
+                event.update(order_id=order_id, store_id=order['store_id'], departments=departments.get(order_id, []))
+                conn.publish(EVENTS_CHANNEL % order['store_id'], json.dumps(event, cls=DjangoJSONEncoder))
+    except:
+        from api.models import Log
+        Log.objects.create(category='orders', function='publish_order_events', title=str(list(orders_events)),
+                           text=traceback.format_exc())
+
+
+def publish_order_events(orders_events):
+    """
+    orders_events - {order_id: [событие, ...]}, событие - компактный словарь ({'type': 'status', 'status_id': 3}).
+    Публикуется после коммита, магазин и отделы заказа ищутся одним запросом на пачку
+    """
+    orders_events = {order_id: list(events) for order_id, events in orders_events.items()}
+    at = timezone.now()
+    for events in orders_events.values():
+        for event in events:
+            event.setdefault('at', at)
+    transaction.on_commit(lambda: _publish(orders_events))
+
+
+def publish_order_event(order_id, event):
+    publish_order_events({order_id: [event]})
+
+
+def order_events_stream(store_ids, access):
+    """ Поток SSE: события заказов магазинов, к отделам которых у юзера есть доступ """
+    conn = get_redis_connection('default')
+    pubsub = conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*[EVENTS_CHANNEL % store_id for store_id in store_ids])
+    # база потоку больше не нужна: соединение (на gevent - свое у каждого потока) возвращаем сразу
+    for db in connections.all():
+        if not db.in_atomic_block:
+            db.close()
+    try:
+        yield 'retry: %s\n\n' % SSE_RETRY_MS
+        started = time.monotonic()
+        while time.monotonic() - started < SSE_MAX_DURATION:
+            message = pubsub.get_message(timeout=SSE_KEEPALIVE)
+            if message is None:
+                yield ': keepalive\n\n'
+                continue
+            data = message['data']
+            if isinstance(data, bytes):
+                data = data.decode()
+            event = json.loads(data)
+            departments = event.pop('departments', [])
+            if not access.is_terminal_man and not any(d in access.department_ids for d in departments):
+                continue
+            yield 'event: order\ndata: %s\n\n' % json.dumps(event)
+    finally:
+        pubsub.close()
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min, OuterRef, Subquery
+
+from orders.models import Order, OrderDraft, OrderPublish, OrderStatusLog
+
+
+class Command(BaseCommand):
+    help = '''
+        Заполняет на заказах created_at/created_by, published_at/publisher, executor_found_at и completed_at
+        из первых черновика, публикации и логов статусов 3 и 4. Пачками по диапазону id, одним UPDATE на пачку
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        bounds = Order.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            return
+
+        # .first() у связанных объектов берет запись с минимальным id
+        draft = OrderDraft.objects.filter(order_id=OuterRef('pk')).order_by('id')
+        publish = OrderPublish.objects.filter(order_id=OuterRef('pk')).order_by('id')
+        executor_log = OrderStatusLog.objects.filter(order_id=OuterRef('pk'), status_id=3).order_by('id')
+        completed_log = OrderStatusLog.objects.filter(order_id=OuterRef('pk'), status_id=4).order_by('id')
+
+        total = 0
+        batch_size = options['batch_size']
+        for start in range(bounds['min_id'], bounds['max_id'] + 1, batch_size):
+            total += Order.objects.filter(id__gte=start, id__lt=start + batch_size).update(
+                created_at=Subquery(draft.values('created')[:1]),
+                created_by=Subquery(draft.values('employee_id')[:1]),
+                published_at=Subquery(publish.values('created')[:1]),
+                publisher=Subquery(publish.values('employee_id')[:1]),
+                executor_found_at=Subquery(executor_log.values('created')[:1]),
+                completed_at=Subquery(completed_log.values('created')[:1]),
+            )
+            self.stdout.write('%s заказов обновлено' % total)
+        self.stdout.write(self.style.SUCCESS('Готово: %s' % total))
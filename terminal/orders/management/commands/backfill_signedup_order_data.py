@@ -0,0 +1,38 @@
+import traceback
+
+from django.core.management.base import BaseCommand
+
+from api.models import Log
+from orders.models import Order, parse_signedup_order_text
+
+
+class Command(BaseCommand):
+    help = 'Переносит текст заказа (signedup_order_text) в jsonb (signedup_order_data) пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        orders = Order.objects.filter(signedup_order_data__isnull=True).exclude(signedup_order_text='').order_by('id')
+        last_id = 0
+        total = 0
+        failed = 0
+        while True:
+            batch = list(orders.filter(id__gt=last_id).only('id', 'signedup_order_text')[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            updated = []
+            for o in batch:
+                try:
+                    o.signedup_order_data = parse_signedup_order_text(o.signedup_order_text)
+                except:
+                    failed += 1
+                    Log.objects.create(category='orders', function='backfill_signedup_order_data',
+                                       title='order_id=%s' % o.id, text=traceback.format_exc())
+                    continue
+                updated.append(o)
+            Order.objects.bulk_update(updated, ['signedup_order_data'])
+            total += len(updated)
+            self.stdout.write('%s заказов перенесено' % total)
+        self.stdout.write(self.style.SUCCESS('Готово: %s, ошибок: %s' % (total, failed)))
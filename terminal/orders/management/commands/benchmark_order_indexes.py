@@ -0,0 +1,167 @@
+import datetime
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import Q
+
+from orders.models import Order, OrderCustomField, OrderCustomFieldValue, OrderInvoice, OrderSearchIndex, OrderStatusLog
+
+# Индексы из миграций 0035 и 0041, которые сравниваем
+INDEXES = [
+    'orders_status_store_id_idx',
+    'orders_completed_date_idx',
+    'orders_log_order_status_idx',
+    'orders_cfv_order_field_idx',
+    'orders_inv_order_contr_idx',
+    'orders_search_upper_trgm',
+]
+# Запрос, который обязан идти через индекс: иначе каждое нажатие клавиши в поиске - полный проход по таблице
+SEARCH_QUERY = 'orders_search (icontains)'
+SEARCH_INDEX = 'orders_search_upper_trgm'
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = '''
+        Планы (EXPLAIN ANALYZE) и время горячих запросов по заказам без индексов 0035 и с ними.
+        --seed N наполняет базу синтетическими заказами. Только для dev-базы:
+        замер "без индексов" удаляет их внутри транзакции (с откатом), это блокирует таблицы
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Сколько синтетических заказов добавить (например 1000000)')
+        parser.add_argument('--plans', action='store_true', help='Печатать планы целиком')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            self.seed(options['seed'])
+
+        queries = self.queries()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE orders_order, orders_orderstatuslog, orders_ordercustomfieldvalue, orders_orderinvoice, '
+                           'orders_ordersearchindex')
+
+        self.stdout.write(self.style.MIGRATE_HEADING('До (индексы удалены внутри транзакции)'))
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    for index in INDEXES:
+                        cursor.execute('DROP INDEX IF EXISTS %s' % index)
+                before, _ = self.run(queries, options['plans'])
+                raise Rollback
+        except Rollback:
+            pass
+
+        self.stdout.write(self.style.MIGRATE_HEADING('После'))
+        after, plans = self.run(queries, options['plans'])
+        if SEARCH_INDEX not in '\n'.join(plans[SEARCH_QUERY]):
+            self.stdout.write(self.style.ERROR('%s не использует %s:' % (SEARCH_QUERY, SEARCH_INDEX)))
+            self.stdout.write('\n'.join('    ' + line for line in plans[SEARCH_QUERY]))
+
+        self.stdout.write(self.style.MIGRATE_HEADING('Итого, мс'))
+        for name, _ in queries:
+            self.stdout.write('%-40s %10.2f %10.2f' % (name, before[name], after[name]))
+
+    def queries(self):
+        """ Запросы в том виде, в каком их строят orders/views.py и orders/xls.py """
+        order = Order.objects.order_by('-id').first()
+        if not order:
+            raise CommandError('Нет заказов, запустите с --seed')
+        store_id = order.store_id
+        custom_field = OrderCustomField.objects.first()
+        today = datetime.date.today()
+        # середина телефона - подстрока, которую ищут по мере ввода
+        search = (order.phone or '')[-7:-2]
+        querysets = [
+            ('orders_view (store+status, -id)',
+             Order.objects.filter(store_id__in=[store_id], status_id__in=[2, 3, 4, 7]).order_by('-id')[:50]),
+            ('orders_view drafts (status=1, -id)',
+             Order.objects.filter(store_id__in=[store_id], status_id=1).order_by('-id')[:50]),
+            ('xls completed_time::date range',
+             Order.objects.filter(status_id=4, completed_time__date__gte=today - datetime.timedelta(days=365),
+                                  completed_time__date__lte=today).order_by('id')[:500]),
+            ('status log (order, status=4)',
+             OrderStatusLog.objects.filter(order_id=order.id, status_id=4).order_by('id')[:1]),
+            ('custom field value (order, field)',
+             OrderCustomFieldValue.objects.filter(order_id=order.id, custom_field_id=custom_field.id if custom_field else None)[:1]),
+            ('invoices (order, contractor)',
+             OrderInvoice.objects.filter(Q(order_id=order.id), Q(contractor_id=1) | Q(contractor_id=None))),
+            (SEARCH_QUERY,
+             OrderSearchIndex.objects.filter(text__icontains=search).annotate(
+                 rank=TrigramSimilarity('text', search)).order_by('-rank', '-order_id')[:50]),
+        ]
+        return [(name, qs.query.sql_with_params()) for name, qs in querysets]
+
+    def run(self, queries, print_plans):
+        timings = {}
+        plans = {}
+        with connection.cursor() as cursor:
+            for name, (sql, params) in queries:
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT TEXT) ' + sql, params)
+                plan = [row[0] for row in cursor.fetchall()]
+                plans[name] = plan
+                timings[name] = float(plan[-1].split(':')[1].split()[0])
+                self.stdout.write('%s: %s мс' % (name, timings[name]))
+                if print_plans:
+                    self.stdout.write('\n'.join('    ' + line for line in plan))
+                else:
+                    self.stdout.write('    ' + plan[0])
+        return timings, plans
+
+    def seed(self, count):
+        """ Синтетические заказы генерируются на стороне базы (generate_series), пачками по 100к """
+        ClientStore = apps.get_model('clients', 'ClientStore')
+        Service = apps.get_model('services', 'Service')
+        stores = list(ClientStore.objects.values_list('id', flat=True)[:200])
+        services = list(Service.objects.values_list('id', flat=True)[:500])
+        fields = list(OrderCustomField.objects.values_list('id', flat=True)[:20])
+        if not stores or not services:
+            raise CommandError('Для --seed нужны хотя бы одна торговая точка и одна услуга')
+
+        batch = 100000
+        with connection.cursor() as cursor:
+            for offset in range(0, count, batch):
+                n = min(batch, count - offset)
+                cursor.execute('''
+                    INSERT INTO orders_order (phone, signedup_order_text, status_id, store_id, completed_time,
+                                              feedback_requested, send_sms, data_sent)
+                    SELECT '+7' || (9000000000 + floor(random() * 999999999))::bigint, '',
+                           (ARRAY[1, 2, 3, 4, 4, 4, 5, 6, 7])[1 + floor(random() * 9)::int],
+                           (%s::bigint[])[1 + floor(random() * %s)::int],
+                           now() - random() * interval '730 days', false, false, ''
+                    FROM generate_series(1, %s)
+                    RETURNING id
+                ''', [stores, len(stores), n])
+                ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute('''
+                    INSERT INTO orders_orderstatuslog (order_id, status_id, created)
+                    SELECT o.id, s.status_id, o.completed_time
+                    FROM orders_order o, (VALUES (1), (2), (3), (4)) s(status_id)
+                    WHERE o.id = ANY(%s) AND s.status_id <= o.status_id
+                ''', [ids])
+                cursor.execute('''
+                    INSERT INTO orders_orderinvoice (order_id, service_id, count, title)
+                    SELECT o.id, (%s::bigint[])[1 + floor(random() * %s)::int], 1 + floor(random() * 3), 'Услуга'
+                    FROM orders_order o, generate_series(1, 3)
+                    WHERE o.id = ANY(%s)
+                ''', [services, len(services), ids])
+                if fields:
+                    cursor.execute('''
+                        INSERT INTO orders_ordercustomfieldvalue (order_id, custom_field_id, value)
+                        SELECT o.id, f.id, md5(random()::text)
+                        FROM orders_order o, unnest(%s::bigint[]) f(id)
+                        WHERE o.id = ANY(%s)
+                    ''', [fields, ids])
+                cursor.execute('''
+                    INSERT INTO orders_ordersearchindex (order_id, text)
+                    SELECT o.id, o.phone || coalesce(E'\\n' || string_agg(v.value, E'\\n' ORDER BY v.id), '')
+                    FROM orders_order o LEFT JOIN orders_ordercustomfieldvalue v ON v.order_id = o.id
+                    WHERE o.id = ANY(%s)
+                    GROUP BY o.id
+                ''', [ids])
+                self.stdout.write('%s заказов добавлено' % (offset + n))
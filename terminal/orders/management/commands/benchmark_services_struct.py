@@ -0,0 +1,142 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from clients.models import ClientStore, ClientStoreDepartment
+from orders.views import services_struct
+
+
+class Rollback(Exception):
+    pass
+
+
+def services_struct_legacy(all_services_objects, user, order=None, invoices=None):
+    """ services_struct до переписывания, для сравнения """
+    department_data = {}
+    services_by_department = []
+    for service, service_serialize in all_services_objects:
+        if order and order.publish:
+            dep = ClientStoreDepartment.objects.get(
+                id=service_serialize.get('oi_department_id'))
+            if dep in department_data:
+                department_data[dep].append(service_serialize)
+            else:
+                department_data[dep] = [service_serialize]
+        else:
+            if user.is_terminal_man:
+                depts = []
+                for d in service.store.departments():
+                    depts.append(d)
+            else:
+                if user.is_am or user.is_acm:
+                    depts = []
+                    for d in service.store.departments():
+                        depts.append(d)
+                else:
+                    depts = service.departments.filter(employees__in=[user])
+
+            for dep in depts:
+                if not order:
+                    if dep in service.departments.all():
+                        if dep in department_data:
+                            department_data[dep].append(service_serialize)
+                        else:
+                            department_data[dep] = [service_serialize]
+                else:
+                    if service_serialize.get('oi_department_id') == dep.id:
+                        service_serialize.pop('oi_id')
+                        service_serialize.pop('oi_department_id')
+                        if dep in department_data:
+                            department_data[dep].append(service_serialize)
+                        else:
+                            department_data[dep] = [service_serialize]
+
+    for dep, services in department_data.items():
+        services = [k for j, k in enumerate(
+            services) if k not in services[j + 1:]]
+        services.sort(key=lambda item: item.get('discount_type') or '')
+        d = {
+            'department_title': dep.title,
+            'department_id': dep.id,
+            'department_services': services
+        }
+        services_by_department.append(d)
+    return services_by_department
+
+
+class Command(BaseCommand):
+    help = '''
+        Сравнение services_struct до и после переписывания: время, число запросов и совпадение результата.
+        Магазин добивается копиями своих отделов и услуг до --departments и --services,
+        все изменения откатываются в конце
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('store_id', type=int)
+        parser.add_argument('user_id', type=int)
+        parser.add_argument('--services', type=int, default=500)
+        parser.add_argument('--departments', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        store = ClientStore.objects.filter(id=options['store_id']).first()
+        user = get_user_model().objects.filter(id=options['user_id']).first()
+        if not store or not user:
+            raise CommandError('Магазин или юзер не найден')
+
+        try:
+            with transaction.atomic():
+                self.seed(store, user, options['services'], options['departments'])
+                self.compare(store, user, options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, store, user, services_count, departments_count):
+        departments = list(store.departments())
+        if not departments:
+            raise CommandError('У магазина нет отделов')
+        while len(departments) < departments_count:
+            dep = ClientStoreDepartment.objects.get(id=departments[0].id)
+            dep.pk = None
+            dep.id = None
+            dep.title = '%s %s' % (departments[0].title, len(departments))
+            dep.save()
+            departments.append(dep)
+        for dep in departments:
+            dep.employees.add(user)
+
+        services = list(store.services(user=user))
+        if not services:
+            raise CommandError('У магазина нет услуг')
+        template = services[0]
+        for i in range(len(services), services_count):
+            service = type(template).objects.get(id=template.id)
+            service.pk = None
+            service.id = None
+            service.title = '%s %s' % (template.title, i)
+            service.save()
+            service.departments.set(random.sample(departments, min(3, len(departments))))
+        self.stdout.write('Отделов: %s, услуг: %s' % (len(departments), max(services_count, len(services))))
+
+    def compare(self, store, user, repeat):
+        results = {}
+        for name, func in (('до', services_struct_legacy), ('после', services_struct)):
+            timings = []
+            for _ in range(repeat):
+                # каждый прогон на свежих объектах, чтобы prefetch не достался от предыдущего
+                all_services_objects = [[s, s.serialize()] for s in store.services(user=user)]
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.monotonic()
+                    result = func(all_services_objects, user)
+                    timings.append(time.monotonic() - started)
+                results[name] = result
+            self.stdout.write('%-6s %8.1f мс, запросов: %s' % (name, min(timings) * 1000, len(queries.captured_queries)))
+
+        if results['до'] != results['после']:
+            raise CommandError('Результаты отличаются')
+        self.stdout.write(self.style.SUCCESS('Результаты совпадают'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import Order, OrderExportRow
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает строки выгрузки (OrderExportRow) для выполненных заказов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--missing-only', action='store_true', help='Только заказы без строки выгрузки')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.filter(status_id=4).order_by('id')
+        if options['missing_only']:
+            orders = orders.filter(export_row__isnull=True)
+
+        last_id = 0
+        total = 0
+        while True:
+            orders_id = list(orders.filter(id__gt=last_id).values_list('id', flat=True)[:options['batch_size']])
+            if not orders_id:
+                break
+            OrderExportRow.rebuild(orders_id)
+            total += len(orders_id)
+            last_id = orders_id[-1]
+            self.stdout.write('%s заказов обработано' % total)
+        self.stdout.write(self.style.SUCCESS('Готово: %s' % total))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import Order, OrderSearchIndex
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает поисковый индекс заказов (OrderSearchIndex)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        orders = Order.objects.order_by('id')
+        last_id = 0
+        total = 0
+        while True:
+            orders_id = list(orders.filter(id__gt=last_id).values_list('id', flat=True)[:options['batch_size']])
+            if not orders_id:
+                break
+            OrderSearchIndex.rebuild(orders_id)
+            total += len(orders_id)
+            last_id = orders_id[-1]
+            self.stdout.write('%s заказов обработано' % total)
+        self.stdout.write(self.style.SUCCESS('Готово: %s' % total))
@@ -0,0 +1,56 @@
+# Generated by Django 3.2.3 on 2026-10-17 09:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('orders', '0030_orderxls_file_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderxls',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата создания'),
+        ),
+        migrations.AddField(
+            model_name='orderxls',
+            name='params',
+            field=models.TextField(blank=True, null=True, verbose_name='Параметры выгрузки'),
+        ),
+        migrations.AddField(
+            model_name='orderxls',
+            name='params_hash',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='Хеш параметров выгрузки'),
+        ),
+        migrations.AddField(
+            model_name='orderxls',
+            name='rows_done',
+            field=models.PositiveIntegerField(default=0, verbose_name='Обработано заказов'),
+        ),
+        migrations.AddField(
+            model_name='orderxls',
+            name='rows_total',
+            field=models.PositiveIntegerField(default=0, verbose_name='Всего заказов'),
+        ),
+        migrations.AddField(
+            model_name='orderxls',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В очереди'), ('running', 'Формируется'), ('done', 'Готово'), ('failed', 'Ошибка')], default='done', max_length=255, verbose_name='Статус'),
+        ),
+        migrations.AddField(
+            model_name='orderxls',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Сотрудник'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderxls',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['pending', 'running'])), fields=('params_hash',), name='orders_orderxls_active_params_hash_uniq'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.3 on 2026-10-17 09:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0031_orderxls_export_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderExportRow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(blank=True, null=True, verbose_name='Дата создания заказа')),
+                ('publish_date', models.DateTimeField(blank=True, null=True, verbose_name='Дата публикации заказа')),
+                ('publish_fio', models.TextField(blank=True, null=True, verbose_name='Сотрудник, опубликовавший заказ')),
+                ('date_find_executor', models.CharField(blank=True, max_length=255, verbose_name='Нашли исполнителя')),
+                ('date_completed', models.CharField(blank=True, max_length=255, verbose_name='Закрыли заказ')),
+                ('feedback_rate', models.FloatField(blank=True, null=True, verbose_name='Отзыв')),
+                ('executor_fio', models.TextField(blank=True, verbose_name='Исполнитель')),
+                ('services_text', models.TextField(blank=True, verbose_name='Перечень услуг в заказе')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='export_row', to='orders.order', verbose_name='Заказ')),
+            ],
+            options={
+                'verbose_name': 'Строка выгрузки заказа',
+                'verbose_name_plural': 'Строки выгрузки заказов',
+            },
+        ),
+    ]
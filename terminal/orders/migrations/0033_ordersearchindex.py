@@ -0,0 +1,32 @@
+# Generated by Django 3.2.3 on 2026-10-17 10:30
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0032_orderexportrow'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.CreateModel(
+            name='OrderSearchIndex',
+            fields=[
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_index', serialize=False, to='orders.order', verbose_name='Заказ')),
+                ('text', models.TextField(blank=True, verbose_name='Текст для поиска')),
+            ],
+            options={
+                'verbose_name': 'Поисковый индекс заказа',
+                'verbose_name_plural': 'Поисковые индексы заказов',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='ordersearchindex',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['text'], name='orders_search_text_trgm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
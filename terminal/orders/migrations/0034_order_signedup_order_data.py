@@ -0,0 +1,27 @@
+# Generated by Django 3.2.3 on 2026-10-17 11:00
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # GIN индекс по всей таблице заказов строится долго: CONCURRENTLY не блокирует запись, но только вне транзакции
+    atomic = False
+
+    dependencies = [
+        ('orders', '0033_ordersearchindex'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='signedup_order_data',
+            field=models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='Данные заказа'),
+        ),
+        AddIndexConcurrently(
+            model_name='order',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['signedup_order_data'], name='orders_order_data_gin', opclasses=['jsonb_path_ops']),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.3 on 2026-10-17 11:30
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+import django.db.models.functions.datetime
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY не может выполняться внутри транзакции, зато не блокирует запись в таблицы
+    atomic = False
+
+    dependencies = [
+        ('orders', '0034_order_signedup_order_data'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['status', 'store', '-id'], name='orders_status_store_id_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(django.db.models.functions.datetime.TruncDate('completed_time'), condition=models.Q(('status_id', 4)), name='orders_completed_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='orderstatuslog',
+            index=models.Index(fields=['order', 'status'], name='orders_log_order_status_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ordercustomfieldvalue',
+            index=models.Index(fields=['order', 'custom_field'], name='orders_cfv_order_field_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='orderinvoice',
+            index=models.Index(fields=['order', 'contractor'], name='orders_inv_order_contr_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.3 on 2026-10-17 13:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def create_retry_schedule(apps, schema_editor):
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.update_or_create(
+        name='orders_retry_order_outbox',
+        defaults={'func': 'orders.tasks.retry_order_outbox', 'schedule_type': 'I', 'minutes': 10, 'repeats': -1})
+
+
+def delete_retry_schedule(apps, schema_editor):
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.filter(name='orders_retry_order_outbox').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('orders', '0035_order_access_indexes'),
+        ('django_q', '0009_auto_20171009_0915'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает отправки'), ('sent', 'Отправлен'), ('failed', 'Ошибка')], default='pending', max_length=255, verbose_name='Статус')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Попыток')),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Следующая попытка')),
+                ('last_error', models.TextField(blank=True, verbose_name='Последняя ошибка')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата создания')),
+                ('sent', models.DateTimeField(blank=True, null=True, verbose_name='Дата отправки')),
+                ('employee', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Сотрудник')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='orders.order', verbose_name='Заказ')),
+            ],
+            options={
+                'verbose_name': 'Отправка заказа в сайнап',
+                'verbose_name_plural': 'Отправки заказов в сайнап',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='orderoutbox',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'pending')), fields=('order',), name='orders_outbox_pending_order_uniq'),
+        ),
+        migrations.RunPython(create_retry_schedule, delete_retry_schedule),
+    ]
@@ -0,0 +1,91 @@
+# Generated by Django 3.2.3 on 2026-10-17 15:10
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+from django.db.models import Max, Min, OuterRef, Subquery
+import django.db.models.deletion
+
+BATCH_SIZE = 5000
+
+
+def fill_log_dates(apps, schema_editor):
+    """ То же, что backfill_order_log_dates: пачками по диапазону id, каждая пачка - свой UPDATE вне транзакции """
+    Order = apps.get_model('orders', 'Order')
+    OrderDraft = apps.get_model('orders', 'OrderDraft')
+    OrderPublish = apps.get_model('orders', 'OrderPublish')
+    OrderStatusLog = apps.get_model('orders', 'OrderStatusLog')
+    bounds = Order.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+    if bounds['min_id'] is None:
+        return
+
+    draft = OrderDraft.objects.filter(order_id=OuterRef('pk')).order_by('id')
+    publish = OrderPublish.objects.filter(order_id=OuterRef('pk')).order_by('id')
+    executor_log = OrderStatusLog.objects.filter(order_id=OuterRef('pk'), status_id=3).order_by('id')
+    completed_log = OrderStatusLog.objects.filter(order_id=OuterRef('pk'), status_id=4).order_by('id')
+    for start in range(bounds['min_id'], bounds['max_id'] + 1, BATCH_SIZE):
+        Order.objects.filter(id__gte=start, id__lt=start + BATCH_SIZE).update(
+            created_at=Subquery(draft.values('created')[:1]),
+            created_by=Subquery(draft.values('employee_id')[:1]),
+            published_at=Subquery(publish.values('created')[:1]),
+            publisher=Subquery(publish.values('employee_id')[:1]),
+            executor_found_at=Subquery(executor_log.values('created')[:1]),
+            completed_at=Subquery(completed_log.values('created')[:1]),
+        )
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY не может выполняться внутри транзакции. Значения заполняются здесь же, до индексов;
+    # backfill_order_log_dates - для повторного пересчета
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('orders', '0036_orderoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='created_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата создания заказа'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='created_by',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Создал'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='published_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата публикации заказа'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='publisher',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Опубликовал'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='executor_found_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата назначения исполнителя'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата выполнения'),
+        ),
+        migrations.RunPython(fill_log_dates, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['created_at'], name='orders_created_at_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['published_at'], name='orders_published_at_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['completed_at'], name='orders_completed_at_idx'),
+        ),
+    ]
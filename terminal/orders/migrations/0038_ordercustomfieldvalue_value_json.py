@@ -0,0 +1,54 @@
+# Generated by Django 3.2.3 on 2026-10-17 17:40
+
+import ast
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def dict_value(value):
+    """ Копия orders.payload.dict_value на момент миграции """
+    if not isinstance(value, str) or not value.lstrip().startswith('{'):
+        return None
+    for text in (value, value.replace('Decimal', '')):
+        try:
+            parsed = ast.literal_eval(text)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+        return parsed if isinstance(parsed, dict) else None
+    return None
+
+
+def fill_value_json(apps, schema_editor):
+    OrderCustomFieldValue = apps.get_model('orders', 'OrderCustomFieldValue')
+    values = OrderCustomFieldValue.objects.filter(value__startswith='{').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(values.filter(id__gt=last_id).only('id', 'value')[:BATCH_SIZE])
+        if not batch:
+            break
+        last_id = batch[-1].id
+        updated = []
+        for v in batch:
+            v.value_json = dict_value(v.value)
+            if v.value_json is not None:
+                updated.append(v)
+        OrderCustomFieldValue.objects.bulk_update(updated, ['value_json'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0037_order_log_dates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ordercustomfieldvalue',
+            name='value_json',
+            field=models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='Значение-объект'),
+        ),
+        migrations.RunPython(fill_value_json, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.3 on 2026-10-17 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0038_ordercustomfieldvalue_value_json'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderoutbox',
+            name='order_text',
+            field=models.TextField(blank=True, null=True, verbose_name='Текст заказа для сайнапа'),
+        ),
+        migrations.AddField(
+            model_name='orderoutbox',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Занята до'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.3 on 2026-10-17 19:50
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0039_orderoutbox_order_text_locked_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderxls',
+            name='heartbeat',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Последний прогресс'),
+        ),
+    ]
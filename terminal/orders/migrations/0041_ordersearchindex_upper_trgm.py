@@ -0,0 +1,26 @@
+# Generated by Django 3.2.3 on 2026-10-18 10:00
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+    # индекс по всем заказам: строим без блокировки записи, CONCURRENTLY - только вне транзакции
+    atomic = False
+
+    dependencies = [
+        ('orders', '0040_orderxls_heartbeat'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='ordersearchindex',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('text'), name='gin_trgm_ops'), name='orders_search_upper_trgm'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='ordersearchindex',
+            name='orders_search_text_trgm',
+        ),
+    ]
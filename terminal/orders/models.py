@@ -1,8 +1,13 @@
+import ast
+import json
 import secrets
 import uuid
 
-from django.conf import settings
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models import prefetch_related_objects
+from django.db.models.functions import TruncDate, Upper
 from django.utils import timezone
 
 from api.mixins import ModelDiffMixin
@@ -37,6 +42,9 @@ class OrderStatusLog(models.Model):
     class Meta:
         verbose_name = 'Лог Статуса заказа'
         verbose_name_plural = 'Логи Статусов заказов'
+        indexes = [
+            models.Index(fields=['order', 'status'], name='orders_log_order_status_idx'),
+        ]
 
     @property
     def get_title(self):
@@ -64,6 +72,9 @@ class OrderInvoice(models.Model):
     class Meta:
         verbose_name = 'Инвойс'
         verbose_name_plural = 'Инвойс'
+        indexes = [
+            models.Index(fields=['order', 'contractor'], name='orders_inv_order_contr_idx'),
+        ]
 
     def __str__(self):
         return '%s' % self.id
@@ -89,17 +100,8 @@ class OrderInvoice(models.Model):
         return sc.cost
 
     def get_cost(self, services, x):
-        from services.models import ServiceDiscount
-        absolute_discounts = ServiceDiscount.objects.filter(service__in=services, discount_type_id=2)
-        for sd in absolute_discounts:
-            x += sd.value
-        relative_discounts = ServiceDiscount.objects.filter(service__in=services, discount_type_id=1).order_by(
-            'service_id')
-        x = float(x)
-        for sd in relative_discounts:
-            x *= float(sd.value)
-        x = round(x - 0.001, 2)
-        return x
+        from orders.pricing import invoices_costs
+        return invoices_costs([(services, x)])[0]
 
 
 class Feedback(models.Model):
@@ -148,9 +150,34 @@ class FeedbackImage(models.Model):
         return self.image_link.split('?')[0]
 
 
+def signedup_order_json(data):
+    """
+    Данные заказа в виде для jsonb: Decimal становятся строками (как после eval без 'Decimal'),
+    даты - списком, чтобы по ним можно было искать через GIN индекс
+    """
+    data = json.loads(json.dumps(data, cls=DjangoJSONEncoder))
+    if isinstance(data.get('dates'), str):
+        data['dates'] = data['dates'].split(',')
+    return data
+
+
+def parse_signedup_order_text(text):
+    """ Разбор старого текстового формата (repr словаря) без eval """
+    if isinstance(text, dict):
+        return signedup_order_json(text)
+    if not text:
+        return {}
+    return signedup_order_json(ast.literal_eval(text.replace('Decimal', '')))
+
+
+# Колонки заказа, которые копируют даты черновика, публикации и логов статусов 3 и 4
+LOG_DATE_FIELDS = ['created_at', 'created_by_id', 'published_at', 'publisher_id', 'executor_found_at', 'completed_at']
+
+
 class Order(models.Model, ModelDiffMixin):
     phone = models.CharField('Телефон', max_length=255)
     signedup_order_text = models.TextField('Текст заказа', blank=True)
+    signedup_order_data = models.JSONField('Данные заказа', null=True, blank=True, encoder=DjangoJSONEncoder)
     status = models.ForeignKey(OrderStatus, verbose_name='Статус заказа', on_delete=models.CASCADE)
     store = models.ForeignKey('clients.ClientStore', verbose_name='Торговая точка', on_delete=models.CASCADE, null=True)
     department = models.ForeignKey('clients.ClientStoreDepartment', verbose_name='Отдел Торговой точки', on_delete=models.CASCADE, null=True, related_name='order_department')
@@ -161,50 +188,60 @@ class Order(models.Model, ModelDiffMixin):
     send_sms = models.BooleanField('СМС отправлен', default=False)
     data_sent = models.TextField('Данные, отправленные в сайнап', blank=True)
     cost = models.DecimalField('Цена заказа', max_digits=12, decimal_places=2, null=True, blank=True)
+    # Даты из первых черновика, публикации и логов статусов 3 и 4 - копия, чтобы не искать их на каждом чтении
+    created_at = models.DateTimeField('Дата создания заказа', null=True, blank=True)
+    created_by = models.ForeignKey('users.User', verbose_name='Создал', on_delete=models.SET_NULL, null=True, blank=True,
+                                   related_name='+', db_index=False)
+    published_at = models.DateTimeField('Дата публикации заказа', null=True, blank=True)
+    publisher = models.ForeignKey('users.User', verbose_name='Опубликовал', on_delete=models.SET_NULL, null=True, blank=True,
+                                  related_name='+', db_index=False)
+    executor_found_at = models.DateTimeField('Дата назначения исполнителя', null=True, blank=True)
+    completed_at = models.DateTimeField('Дата выполнения', null=True, blank=True)
 
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы'
+        indexes = [
+            models.Index(fields=['created_at'], name='orders_created_at_idx'),
+            models.Index(fields=['published_at'], name='orders_published_at_idx'),
+            models.Index(fields=['completed_at'], name='orders_completed_at_idx'),
+            GinIndex(fields=['signedup_order_data'], name='orders_order_data_gin', opclasses=['jsonb_path_ops']),
+            # списки заказов: store_id + status_id, сортировка по -id
+            models.Index(fields=['status', 'store', '-id'], name='orders_status_store_id_idx'),
+            # выгрузка выполненных заказов по диапазону completed_time::date
+            models.Index(TruncDate('completed_time'), name='orders_completed_date_idx', condition=models.Q(status_id=4)),
+        ]
 
     def __str__(self):
         return '%s' % self.id
 
     def price(self, invoices=None, signedup=False, contractor=False, aggregator_id=None):
-        from services.models import ServiceDiscount
+        # Суммируем все primary * count, прибавляем discount типа absolute и умножаем на discount типа relative
+        # в порядке services_service_id. Расчет в orders.pricing, там же пакетный вариант для многих заказов.
+        from orders.pricing import orders_prices
         if not invoices:
             invoices = OrderInvoice.objects.filter(order=self).select_related('service')
-        services = [oi.service for oi in invoices]
-        # Суммируем все primary * count привязанные к этому order.
-        if signedup:
-            if invoices[0].contractor_id is not None:
-                x = sum([invoice.count * float(invoice.cost_signedup) for invoice in invoices if invoice.service.service_type_id == 1 and invoice.cost_signedup])
-            else:
-               x = sum([invoice.count * float(invoice.cost) for invoice in invoices if invoice.service.service_type_id == 1])
-        elif contractor:
-            x = sum([invoice.count * float(invoice.cost_contractor) for invoice in invoices if invoice.service.service_type_id == 1 and invoice.cost_contractor and invoice.contractor_id != aggregator_id])
-        else:
-            x = sum([invoice.count * float(invoice.cost) for invoice in invoices if invoice.service.service_type_id == 1])
-        # Прибавляем все discount типа absolute. Запоминаем это число как X.
-        absolute_discounts = ServiceDiscount.objects.filter(service__in=services, discount_type_id=2)
-        for sd in absolute_discounts:
-            x += sd.value
-        # И полученную сумму (`X`) умножаем на discount типа relative. Запоминаем это значение как Y.
-        # Если есть 2-й discount типа relative, проводим такую же оперцию, но за основу берем число Y. Очередность применения discount типа relative считаем по их services_service_id.
-        relative_discounts = ServiceDiscount.objects.filter(service__in=services, discount_type_id=1).order_by('service_id')
-        x = float(x)
-        for sd in relative_discounts:
-            x *= float(sd.value)
-        x = round(x - 0.001, 2)
-        return x
+        return orders_prices([list(invoices)], signedup=signedup, contractor=contractor, aggregator_id=aggregator_id)[0]
 
     def full_price(self, invoices):
         price = sum([invoice.count*float(invoice.cost) for invoice in invoices if invoice.order_id == self.id])
         return price
 
+    @property
+    def order_data(self):
+        """ Данные заказа из jsonb, для еще не перенесенных заказов - разбор текста """
+        if self.signedup_order_data is not None:
+            return self.signedup_order_data
+        return parse_signedup_order_text(self.signedup_order_text)
+
+    def set_order_data(self, data):
+        """ Текст для сайнапа остается в прежнем формате, рядом сохраняются те же данные в jsonb """
+        self.signedup_order_text = data
+        self.signedup_order_data = signedup_order_json(data)
+
     @property
     def eval_fields(self):
-        fields = eval(self.signedup_order_text.replace('Decimal', ''))
-        return fields['fields']
+        return self.order_data.get('fields', [])
 
     @property
     def subcategory_titles(self):
@@ -217,34 +254,39 @@ class Order(models.Model, ModelDiffMixin):
 
     @property
     def draft(self):
+        # загруженное заранее (orders.card.load_order) берется без запроса
+        if hasattr(self, '_draft'):
+            return self._draft
         return OrderDraft.objects.filter(order=self).first()
 
     @property
     def publish(self):
+        if hasattr(self, '_publish'):
+            return self._publish
         return OrderPublish.objects.filter(order=self).first()
 
     @property
     def date(self):
-        return self.draft.created if self.draft else '?'
+        return self.created_at if self.created_at else '?'
 
     @property
     def fio(self):
-        return self.draft.employee.full_name if self.draft else '?'
+        return self.created_by.full_name if self.created_by_id else '?'
 
     @property
     def publish_date(self):
-        if self.publish:
-            return self.publish.created
-        return None
+        return self.published_at
 
     @property
     def publish_fio(self):
-        if self.publish:
-            return self.publish.employee.full_name
+        if self.publisher_id:
+            return self.publisher.full_name
         return None
 
     @property
     def feedback_obj(self):
+        if hasattr(self, '_feedback'):
+            return self._feedback
         f = Feedback.objects.filter(order=self).first()
         return f
 
@@ -269,12 +311,22 @@ class Order(models.Model, ModelDiffMixin):
 
     @property
     def dates(self):
-        fields = eval(self.signedup_order_text.replace('Decimal', ''))
-        return fields.get('dates', '')
-
-    def get_signedup_order_text(self, dates=None):
-        services = [oi.service.serialize(oi) for oi in OrderInvoice.objects.filter(order=self).select_related('service')]
-        fields = [field_value.custom_field.serialize(field_value) for field_value in OrderCustomFieldValue.objects.filter(order=self).order_by('custom_field__index_number')]
+        dates = self.order_data.get('dates', '')
+        if isinstance(dates, list):
+            return ','.join(dates)
+        return dates
+
+    def get_signedup_order_text(self, dates=None, invoices=None, field_values=None):
+        """ invoices и field_values можно передать уже загруженными (с service и custom_field), тогда без запросов """
+        if invoices is None:
+            invoices = OrderInvoice.objects.filter(order=self).select_related('service')
+        if field_values is None:
+            field_values = OrderCustomFieldValue.objects.filter(order=self).select_related(
+                'custom_field__field_type').order_by('custom_field__index_number')
+        else:
+            field_values = sorted(field_values, key=lambda field_value: field_value.custom_field.index_number)
+        services = [oi.service.serialize(oi) for oi in invoices]
+        fields = [field_value.custom_field.serialize(field_value) for field_value in field_values]
         data = {
             'services': services,
             'fields': fields,
@@ -285,19 +337,60 @@ class Order(models.Model, ModelDiffMixin):
 
     @property
     def date_find_executor(self):
-        d = ''
-        l = OrderStatusLog.objects.filter(order=self, status_id=3).first()
-        if l:
-            return l.created.strftime('%Y-%m-%d %H:%M')
-        return d
+        if self.executor_found_at:
+            return self.executor_found_at.strftime('%Y-%m-%d %H:%M')
+        return ''
 
     @property
     def date_completed(self):
-        d = ''
-        l = OrderStatusLog.objects.filter(order=self, status_id=4).first()
-        if l:
-            return timezone.localtime(l.created).strftime('%Y-%m-%d %H:%M')
-        return d
+        if self.completed_at:
+            return timezone.localtime(self.completed_at).strftime('%Y-%m-%d %H:%M')
+        return ''
+
+    @classmethod
+    def log_dates(cls, orders_id):
+        """ {order_id: даты и сотрудники из первых (по id) черновика, публикации и логов статусов 3 и 4} """
+        orders_id = set(orders_id)
+        drafts, publishes, logs = {}, {}, {}
+        for order_id, created, employee_id in OrderDraft.objects.filter(order_id__in=orders_id).order_by('-id').values_list(
+                'order_id', 'created', 'employee_id'):
+            drafts[order_id] = (created, employee_id)
+        for order_id, created, employee_id in OrderPublish.objects.filter(order_id__in=orders_id).order_by('-id').values_list(
+                'order_id', 'created', 'employee_id'):
+            publishes[order_id] = (created, employee_id)
+        for order_id, status_id, created in OrderStatusLog.objects.filter(
+                order_id__in=orders_id, status_id__in=[3, 4]).order_by('-id').values_list('order_id', 'status_id', 'created'):
+            logs[(order_id, status_id)] = created
+        values = {}
+        for order_id in orders_id:
+            draft = drafts.get(order_id, (None, None))
+            publish = publishes.get(order_id, (None, None))
+            values[order_id] = {
+                'created_at': draft[0],
+                'created_by_id': draft[1],
+                'published_at': publish[0],
+                'publisher_id': publish[1],
+                'executor_found_at': logs.get((order_id, 3)),
+                'completed_at': logs.get((order_id, 4)),
+            }
+        return values
+
+    @classmethod
+    def sync_orders_log_dates(cls, orders_id):
+        """ Пересчет дат пачки заказов: три запроса на пачку и update на заказ, без сигналов """
+        for order_id, values in cls.log_dates(orders_id).items():
+            cls.objects.filter(id=order_id).update(**values)
+
+    def sync_log_dates(self):
+        """
+        Пересчет дат из черновиков, публикаций и логов статусов (берутся первые по id, как раньше .first()).
+        Запросом update, без сигналов; значения обновляются и на объекте
+        """
+        values = self.log_dates([self.id])[self.id]
+        Order.objects.filter(id=self.id).update(**values)
+        for name, value in values.items():
+            setattr(self, name, value)
+        self._loaded_log_dates = self._log_dates_state()
 
     def signedup_order_text_for_xls(self, invoice=None):
         if invoice:
@@ -333,16 +426,28 @@ class Order(models.Model, ModelDiffMixin):
         return None
 
     def serialize(self, is_admin=False, feedbacks=None):
-        dd = self.deparments_dict
-        departments_str = ', '.join([d['title'] for d in dd])
-        data = {'id': self.id, 'date': self.date, 'fio': self.fio, 'published': True if self.publish else False, 'send_sms': self.send_sms}
-        data.update({'status': self.status.title, 'departments': dd, 'departments_str': departments_str})
-        data.update(self.feedback)
-
+        first_feedback = self.feedback_obj
         if feedbacks:
             f = next(iter([i for i in feedbacks if i.order_id == self.id]), None)
         else:
-            f = self.feedback_obj
+            f = first_feedback
+
+        from aidu.models import ScheduleTask
+        return self._serialize(first_feedback, f, ScheduleTask.objects.filter(task_id=self.id))
+
+    def _serialize(self, first_feedback, f, schedule_tasks):
+        dd = self.deparments_dict
+        departments_str = ', '.join([d['title'] for d in dd])
+        data = {'id': self.id, 'date': self.date, 'fio': self.fio,
+                'published': self.published_at is not None, 'send_sms': self.send_sms}
+        data.update({'status': self.status.title, 'departments': dd, 'departments_str': departments_str})
+        feedback_rate = None
+        try:
+            if first_feedback:
+                feedback_rate = round((first_feedback.adequacy + first_feedback.decency + first_feedback.punctuality) / 3, 1)
+        except:
+            pass
+        data.update({'feedback': feedback_rate})
 
         documents_uploaded = True if f and f.agreement_link else False
         data.update({'documents_uploaded': documents_uploaded})
@@ -352,8 +457,7 @@ class Order(models.Model, ModelDiffMixin):
         data['city_title'] = store.city.title
         data['date_completed'] = self.date_completed
 
-        from aidu.models import ScheduleTask
-        data['dates'] = [st.serialize() for st in ScheduleTask.objects.filter(task_id=self.id)]
+        data['dates'] = [st.serialize() for st in schedule_tasks]
 
         data['executor_fio'] = ''
         if f:
@@ -361,12 +465,148 @@ class Order(models.Model, ModelDiffMixin):
             data['executor_id'] = f.executor_id
         return data
 
+    @classmethod
+    def serialize_many(cls, orders, is_admin=False, with_address=False):
+        """ Сериализация страницы заказов за фиксированное число запросов, результат такой же, как у serialize() """
+        from aidu.models import ScheduleTask
+        orders = list(orders)
+        prefetch_related_objects(orders, 'departments', 'status', 'store__client', 'store__city', 'created_by')
+        orders_id = [o.id for o in orders]
+
+        # .first() у связанных объектов берет запись с минимальным id, поэтому сортируем по id и берем первую
+        feedbacks = {}
+        for f in Feedback.objects.filter(order_id__in=orders_id).order_by('id'):
+            feedbacks.setdefault(f.order_id, f)
+        schedule_tasks = {}
+        for st in ScheduleTask.objects.filter(task_id__in=orders_id):
+            schedule_tasks.setdefault(st.task_id, []).append(st)
+        addresses = {}
+        if with_address:
+            for a in OrderCustomFieldValue.objects.filter(custom_field__field_name='address', order_id__in=orders_id):
+                addresses.setdefault(a.order_id, a.value)
+
+        data = []
+        for o in orders:
+            f = feedbacks.get(o.id)
+            order_data = o._serialize(f, f, schedule_tasks.get(o.id, []))
+            if with_address:
+                order_data['address'] = addresses.get(o.id, '')
+            data.append(order_data)
+        return data
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_log_dates = instance._log_dates_state()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._loaded_log_dates = self._log_dates_state()
+
+    def _log_dates_state(self):
+        return {name: self.__dict__.get(name) for name in LOG_DATE_FIELDS}
+
+    def _save_update_fields(self):
+        """
+        Поля для обычного save загруженного заказа: даты из логов - только если их поменяли на этом объекте.
+        Иначе устаревший объект записал бы поверх sync_log_dates свои старые значения
+        """
+        loaded = self._loaded_log_dates
+        current = self._log_dates_state()
+        deferred = self.get_deferred_fields()
+        return [f.name for f in self._meta.concrete_fields if not f.primary_key and f.attname not in deferred and (
+            f.attname not in loaded or current[f.attname] != loaded[f.attname])]
+
     def save(self, need_send_sms=False, *args, **kwargs):
         if self.id and self.phone and 'phone' in self.changed_fields and need_send_sms:
             if self.send_sms:
                 from api.utils import send_sms
-                send_sms(self.phone, 'Ваша заявка №%s оформлена' % self.id)
-        return super().save(*args, **kwargs)
+                # смс уходит только если правка закоммичена
+                phone, text = self.phone, 'Ваша заявка №%s оформлена' % self.id
+                transaction.on_commit(lambda: send_sms(phone, text))
+        if (not args and kwargs.get('update_fields') is None and not kwargs.get('force_insert')
+                and not self._state.adding and hasattr(self, '_loaded_log_dates')):
+            kwargs['update_fields'] = self._save_update_fields()
+        result = super().save(*args, **kwargs)
+        self._loaded_log_dates = self._log_dates_state()
+        return result
+
+
+class OrderExportRow(models.Model):
+    """ Готовые данные выполненного заказа для выгрузки в xlsx, пересобираются при изменении заказа """
+    order = models.OneToOneField(Order, verbose_name='Заказ', on_delete=models.CASCADE, related_name='export_row')
+    date = models.DateTimeField('Дата создания заказа', null=True, blank=True)
+    publish_date = models.DateTimeField('Дата публикации заказа', null=True, blank=True)
+    publish_fio = models.TextField('Сотрудник, опубликовавший заказ', null=True, blank=True)
+    date_find_executor = models.CharField('Нашли исполнителя', max_length=255, blank=True)
+    date_completed = models.CharField('Закрыли заказ', max_length=255, blank=True)
+    feedback_rate = models.FloatField('Отзыв', null=True, blank=True)
+    executor_fio = models.TextField('Исполнитель', blank=True)
+    services_text = models.TextField('Перечень услуг в заказе', blank=True)
+    updated = models.DateTimeField('Дата обновления', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Строка выгрузки заказа'
+        verbose_name_plural = 'Строки выгрузки заказов'
+
+    def __str__(self):
+        return '%s' % self.order_id
+
+    @classmethod
+    def build(cls, order):
+        f = order.feedback_obj
+        feedback_rate = None
+        executor_fio = ''
+        if f:
+            try:
+                feedback_rate = round((f.adequacy + f.decency + f.punctuality) / 3, 1)
+            except:
+                pass
+            executor_fio = f.executor_fio or ''
+        return cls(order=order, date=order.created_at, publish_date=order.publish_date,
+                   publish_fio=order.publish_fio, date_find_executor=order.date_find_executor,
+                   date_completed=order.date_completed, feedback_rate=feedback_rate, executor_fio=executor_fio,
+                   services_text=order.signedup_order_text_for_xls())
+
+    @classmethod
+    def rebuild(cls, orders_id):
+        """ Пересобирает строки выгрузки для выполненных заказов, для остальных удаляет. Возвращает {order_id: row} """
+        orders_id = set(orders_id)
+        rows = {}
+        for order in Order.objects.filter(id__in=orders_id, status_id=4).select_related('publisher'):
+            row = cls.build(order)
+            fields = {f.name: getattr(row, f.name) for f in cls._meta.concrete_fields if f.name not in ('id', 'order')}
+            rows[order.id], _ = cls.objects.update_or_create(order=order, defaults=fields)
+        cls.objects.filter(order_id__in=orders_id - set(rows)).delete()
+        return rows
+
+
+class OrderSearchIndex(models.Model):
+    """ Текст для поиска заказа: телефон и значения кастомных полей, с триграммным индексом """
+    order = models.OneToOneField(Order, verbose_name='Заказ', on_delete=models.CASCADE, primary_key=True, related_name='search_index')
+    text = models.TextField('Текст для поиска', blank=True)
+
+    class Meta:
+        verbose_name = 'Поисковый индекс заказа'
+        verbose_name_plural = 'Поисковые индексы заказов'
+        indexes = [
+            # icontains на Postgres - UPPER("text"::text) LIKE UPPER(%s): индекс должен быть по тому же выражению
+            GinIndex(OpClass(Upper('text'), name='gin_trgm_ops'), name='orders_search_upper_trgm'),
+        ]
+
+    def __str__(self):
+        return '%s' % self.order_id
+
+    @classmethod
+    def rebuild(cls, orders_id):
+        orders_id = set(orders_id)
+        values = {}
+        for order_id, value in OrderCustomFieldValue.objects.filter(order_id__in=orders_id).order_by('id').values_list('order_id', 'value'):
+            values.setdefault(order_id, []).append(value)
+        for order_id, phone in Order.objects.filter(id__in=orders_id).values_list('id', 'phone'):
+            text = '\n'.join([phone] + values.get(order_id, []))
+            cls.objects.update_or_create(order_id=order_id, defaults={'text': text})
 
 
 class OrderDraft(models.Model):
@@ -395,6 +635,47 @@ class OrderPublish(models.Model):
         return '%s' % self.id
 
 
+class OrderOutbox(models.Model):
+    """ Публикация заказа в сайнап: запись создается сразу, доставляет ее фоновая задача с повторами """
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Ожидает отправки'),
+        (STATUS_SENT, 'Отправлен'),
+        (STATUS_FAILED, 'Ошибка'),
+    )
+
+    order = models.ForeignKey(Order, verbose_name='Заказ', on_delete=models.CASCADE)
+    employee = models.ForeignKey('users.User', verbose_name='Сотрудник', on_delete=models.CASCADE)
+    status = models.CharField('Статус', max_length=255, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField('Попыток', default=0)
+    next_attempt = models.DateTimeField('Следующая попытка', default=timezone.now)
+    last_error = models.TextField('Последняя ошибка', blank=True)
+    created = models.DateTimeField('Дата создания', default=timezone.now)
+    sent = models.DateTimeField('Дата отправки', null=True, blank=True)
+    # signedup_order_text в том виде, в каком он был у заказа при публикации (словарь после правки или текст),
+    # в json-тексте: jsonb не сохранил бы порядок ключей, а сайнап получает именно их
+    order_text = models.TextField('Текст заказа для сайнапа', null=True, blank=True)
+    # запись взята воркером в отправку до этого времени, запрос в сайнап идет без транзакции
+    locked_until = models.DateTimeField('Занята до', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Отправка заказа в сайнап'
+        verbose_name_plural = 'Отправки заказов в сайнап'
+        constraints = [
+            # заказ публикуется в сайнап не больше одного раза одновременно
+            models.UniqueConstraint(fields=['order'], condition=models.Q(status='pending'), name='orders_outbox_pending_order_uniq'),
+        ]
+
+    def __str__(self):
+        return '%s' % self.id
+
+    def serialize(self):
+        return {'status': self.status, 'status_title': self.get_status_display(), 'attempts': self.attempts,
+                'error': self.last_error if self.status != self.STATUS_SENT else '', 'sent': self.sent}
+
+
 class OrderCustomFieldTypes(models.Model):
     title = models.CharField('Название', max_length=255, default='text')
 
@@ -408,12 +689,17 @@ class OrderCustomFieldTypes(models.Model):
 
 class OrderCustomFieldValue(models.Model):
     value = models.TextField('Значение')
+    # значение-объект, распознанное при записи (orders.payload.dict_value), для отдачи без разбора текста
+    value_json = models.JSONField('Значение-объект', null=True, blank=True, encoder=DjangoJSONEncoder)
     custom_field = models.ForeignKey('orders.OrderCustomField', verbose_name='Кастомное поле', on_delete=models.CASCADE, null=True)
     order = models.ForeignKey('orders.Order', verbose_name='Заказ', on_delete=models.CASCADE, null=True)
 
     class Meta:
         verbose_name = 'Значение кастомного поля заказа'
         verbose_name_plural = 'Значения кастомных полей заказов'
+        indexes = [
+            models.Index(fields=['order', 'custom_field'], name='orders_cfv_order_field_idx'),
+        ]
 
     def __str__(self):
         return '%s' % self.value
@@ -442,12 +728,7 @@ class OrderCustomField(models.Model):
         d = {'id': self.id, 'index_number': self.index_number, 'field_name': self.field_name,
              'field_type': self.field_type.title, 'size': self.size, 'label':self.label, 'required': self.required}
         if field_value:
-            val = field_value.value
-            try:
-                if type(eval(field_value.value)) == dict:
-                    val = eval(field_value.value)
-            except:
-                pass
+            val = field_value.value_json if field_value.value_json is not None else field_value.value
             d.update({'field_value': val})
         return d
 
@@ -471,12 +752,50 @@ class Customer(models.Model):
 
 # fixme: переделать бы под использование для любых файлов вообще
 class OrderXLS(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'В очереди'),
+        (STATUS_RUNNING, 'Формируется'),
+        (STATUS_DONE, 'Готово'),
+        (STATUS_FAILED, 'Ошибка'),
+    )
+    ACTIVE_STATUSES = (STATUS_PENDING, STATUS_RUNNING)
+
     ids = models.TextField(null=True, blank=True)
     file_type = models.CharField(max_length=255, null=True, blank=True)
     file = models.FileField(upload_to='orders_xls', null=True, blank=True, max_length=500)
+    user = models.ForeignKey('users.User', verbose_name='Сотрудник', on_delete=models.SET_NULL, null=True, blank=True)
+    status = models.CharField('Статус', max_length=255, choices=STATUS_CHOICES, default=STATUS_DONE)
+    params = models.TextField('Параметры выгрузки', null=True, blank=True)
+    params_hash = models.CharField('Хеш параметров выгрузки', max_length=64, null=True, blank=True)
+    rows_done = models.PositiveIntegerField('Обработано заказов', default=0)
+    rows_total = models.PositiveIntegerField('Всего заказов', default=0)
+    created = models.DateTimeField('Дата создания', default=timezone.now)
+    # обновляется при запуске и на каждой обработанной пачке: по нему видно, что выгрузка жива
+    heartbeat = models.DateTimeField('Последний прогресс', default=timezone.now)
+
+    class Meta:
+        constraints = [
+            # одинаковая выгрузка не может формироваться дважды одновременно
+            models.UniqueConstraint(fields=['params_hash'], condition=models.Q(status__in=['pending', 'running']),
+                                    name='orders_orderxls_active_params_hash_uniq'),
+        ]
 
     @property
     def file_url(self):
         if self.file:
             return self.file.url.split('?')[0]
         return ''
+
+    def progress(self, rows):
+        """ Обработано еще rows заказов: счетчик и heartbeat одним update """
+        self.rows_done += rows
+        self.heartbeat = timezone.now()
+        OrderXLS.objects.filter(id=self.id).update(rows_done=self.rows_done, heartbeat=self.heartbeat)
+
+    def serialize(self):
+        return {'id': self.id, 'status': self.status, 'rows_done': self.rows_done, 'rows_total': self.rows_total,
+                'file_url': self.file_url}
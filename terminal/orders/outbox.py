@@ -0,0 +1,195 @@
+import datetime
+import json
+import traceback
+
+import requests
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django_q.models import Schedule
+from django_q.tasks import async_task, schedule
+
+from api.models import Log
+from orders import signedup
+from orders.models import OrderOutbox, OrderPublish, OrderStatusLog
+
+# Повторы: 30с, 1м, 2м, ... но не реже раза в час
+OUTBOX_BACKOFF = 30
+OUTBOX_BACKOFF_MAX = 60 * 60
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'SIGNEDUP_OUTBOX_MAX_ATTEMPTS', 10)
+# На сколько воркер забирает запись в отправку; с запасом больше таймаутов запроса в сайнап с повторами
+OUTBOX_LEASE = 60 * 5
+
+
+def signedup_task_data(o, user, order_text=None):
+    """
+    Данные задачи для сайнапа, те же, что отправлялись при публикации заказа. order_text - signedup_order_text
+    заказа на момент публикации: после создания или правки это был словарь в памяти, а не текст из базы
+    """
+    client = user.client
+
+    client_percents = o.store.client.contractors_percent
+    if client_percents:
+        client_percents = float(client_percents)
+
+    data = {
+        'client_percents': client_percents,
+        'signedup_order_text': o.signedup_order_text if order_text is None else order_text,
+        'signedup_account_api_key': settings.TERMINAL_API_KEY,
+        'title': 'Корпоративный заказ от %s' % o.store.client.title,
+        'subcategory_titles': o.subcategory_titles,
+        'phone': o.phone,
+        'client_name': client.title if client else None,
+        'client_logo': client.get_logo_content() if client else '',
+        'client_type': client.client_type if client else '',
+        'terminal_id': o.id,
+        'city_id': o.store.city.city_id,
+        'customer': o.customer.id
+    }
+    if o.store.contractor_id:
+        data['prefered_contractor_id'] = o.store.contractor_id
+    return data
+
+
+def dump_order_text(o):
+    return json.dumps(o.signedup_order_text, cls=DjangoJSONEncoder)
+
+
+def load_order_text(outbox):
+    """ Сохраненный при публикации signedup_order_text; у записей до появления поля - None (берется текст из базы) """
+    return json.loads(outbox.order_text) if outbox.order_text else None
+
+
+def enqueue_order_publish(o, user):
+    """
+    Публикация заказа: запись в outbox создается в транзакции запроса, отправка - фоновой задачей после коммита.
+    Пока заказ ждет отправки, повторная публикация новую запись не создает
+    """
+    outbox = OrderOutbox.objects.filter(order=o, status=OrderOutbox.STATUS_PENDING).first()
+    if outbox:
+        # еще не отправлен - уйдет последняя версия заказа
+        OrderOutbox.objects.filter(id=outbox.id).update(order_text=dump_order_text(o))
+        return outbox
+    try:
+        with transaction.atomic():
+            outbox = OrderOutbox.objects.create(order=o, employee=user, order_text=dump_order_text(o))
+    except IntegrityError:
+        # параллельный запрос успел создать запись раньше
+        return OrderOutbox.objects.get(order=o, status=OrderOutbox.STATUS_PENDING)
+    outbox_id = outbox.id
+    transaction.on_commit(lambda: async_task('orders.tasks.deliver_order_outbox', outbox_id))
+    return outbox
+
+
+def _response_json(r):
+    try:
+        return r.json()
+    except ValueError:
+        return {}
+
+
+def _publish(outbox, data):
+    o = outbox.order
+    now = timezone.now()
+    o.status_id = 2
+    o.data_sent = data
+    if o.published_at is None:
+        o.published_at = now
+        o.publisher = outbox.employee
+    OrderPublish.objects.create(order=o, employee=outbox.employee, created=now)
+    o.save()
+    OrderStatusLog.objects.create(order=o, status_id=2)
+    outbox.status = OrderOutbox.STATUS_SENT
+    outbox.sent = timezone.now()
+    outbox.locked_until = None
+    outbox.save(update_fields=['status', 'sent', 'locked_until'])
+
+
+def _fail(outbox, error):
+    outbox.status = OrderOutbox.STATUS_FAILED
+    outbox.last_error = error
+    outbox.locked_until = None
+    outbox.save(update_fields=['attempts', 'status', 'last_error', 'locked_until'])
+    Log.objects.create(category='orders', function='order to signedup', title='outbox_id=%s' % outbox.id,
+                       text=error)
+
+
+def _retry(outbox, error):
+    outbox.attempts += 1
+    if outbox.attempts >= OUTBOX_MAX_ATTEMPTS:
+        _fail(outbox, error)
+        return
+
+    delay = min(OUTBOX_BACKOFF * 2 ** (outbox.attempts - 1), OUTBOX_BACKOFF_MAX)
+    outbox.last_error = error
+    outbox.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
+    outbox.locked_until = None
+    outbox.save(update_fields=['attempts', 'last_error', 'next_attempt', 'locked_until'])
+    outbox_id, next_run = outbox.id, outbox.next_attempt
+    transaction.on_commit(lambda: schedule('orders.tasks.deliver_order_outbox', outbox_id,
+                                           schedule_type=Schedule.ONCE, next_run=next_run))
+
+
+def _claim(outbox_id):
+    """
+    Запись берется в отправку одним UPDATE: пока не истек locked_until, плановый повтор и подбор зависших
+    ее не возьмут. Ни транзакция, ни блокировка строки на время запроса в сайнап не держатся
+    """
+    now = timezone.now()
+    claimed = OrderOutbox.objects.filter(id=outbox_id, status=OrderOutbox.STATUS_PENDING).filter(
+        Q(locked_until__isnull=True) | Q(locked_until__lte=now)).update(locked_until=now + datetime.timedelta(seconds=OUTBOX_LEASE))
+    if not claimed:
+        return None
+    return OrderOutbox.objects.select_related('employee', 'order__store__client', 'order__store__city',
+                                              'order__customer').get(id=outbox_id)
+
+
+def _record(outbox_id, result):
+    """ Результат отправки - во второй короткой транзакции. result(outbox) пишет изменения """
+    with transaction.atomic():
+        outbox = OrderOutbox.objects.select_for_update().select_related('order', 'employee').get(id=outbox_id)
+        if outbox.status != OrderOutbox.STATUS_PENDING:
+            return
+        result(outbox)
+
+
+def deliver_order_outbox(outbox_id):
+    """
+    Отправка заказа в сайнап. terminal_id (он же ключ идемпотентности) не дает создать задачу дважды:
+    на повтор уже принятого заказа сайнап отвечает already_exist, и это тоже успех.
+    Сетевые ошибки и 5xx повторяются с нарастающей паузой, остальные ошибки - финальные (видны в карточке заказа)
+    """
+    outbox = _claim(outbox_id)
+    if not outbox:
+        return
+
+    data = signedup_task_data(outbox.order, outbox.employee, load_order_text(outbox))
+    try:
+        r = signedup.post('api/tasks/task/', data, headers={'Idempotency-Key': 'terminal-order-%s' % outbox.order_id})
+    except (requests.RequestException, signedup.SignedUpUnavailable):
+        error = traceback.format_exc()
+        _record(outbox_id, lambda outbox: _retry(outbox, error))
+        return
+
+    if r.status_code == 201:
+        _record(outbox_id, lambda outbox: _publish(outbox, data))
+        return
+
+    Log.objects.create(
+        category='orders', function='order to signedup', title=r.text, text=data)
+    if _response_json(r).get('already_exist'):
+        _record(outbox_id, lambda outbox: _publish(outbox, data))
+    elif r.status_code >= 500 or r.status_code == 429:
+        _record(outbox_id, lambda outbox: _retry(outbox, r.text))
+    else:
+        _record(outbox_id, lambda outbox: _fail(outbox, r.text))
+
+
+def retry_pending_outbox():
+    """ Подбор записей, чья отправка потерялась (воркер упал, задача не дошла до очереди): срок попытки прошел, никем не взята """
+    now = timezone.now()
+    for outbox_id in OrderOutbox.objects.filter(status=OrderOutbox.STATUS_PENDING, next_attempt__lte=now).filter(
+            Q(locked_until__isnull=True) | Q(locked_until__lte=now)).values_list('id', flat=True):
+        deliver_order_outbox(outbox_id)
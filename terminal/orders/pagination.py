@@ -0,0 +1,60 @@
+import base64
+import json
+
+from django.db import connection
+
+NEXT = 'n'
+PREV = 'p'
+
+
+def encode_cursor(direction, order_id):
+    return base64.urlsafe_b64encode(('%s:%s' % (direction, order_id)).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ Пустой курсор - первая страница. Для битого курсора - ValueError """
+    if not cursor:
+        return NEXT, None
+    direction, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+    if direction not in (NEXT, PREV):
+        raise ValueError(cursor)
+    return direction, int(order_id)
+
+
+def approximate_count(queryset):
+    """ Оценка числа строк из плана запроса, без COUNT """
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+def cursor_page(queryset, cursor, count, descending=True):
+    """
+    Страница по курсору (keyset по id): id < / > последнего показанного, LIMIT count + 1.
+    Стоимость не зависит от глубины страницы, в отличие от OFFSET.
+    Возвращает (объекты, курсор следующей страницы, курсор предыдущей страницы)
+    """
+    direction, order_id = decode_cursor(cursor)
+    forward = direction == NEXT
+    # при движении назад идем в обратном порядке и разворачиваем результат
+    ascending = forward != descending
+    if order_id is not None:
+        queryset = queryset.filter(**{'id__gt' if ascending else 'id__lt': order_id})
+    objects = list(queryset.order_by('id' if ascending else '-id')[:count + 1])
+    has_more = len(objects) > count
+    objects = objects[:count]
+    if not forward:
+        objects.reverse()
+
+    next_cursor = None
+    prev_cursor = None
+    if objects:
+        if has_more or not forward:
+            next_cursor = encode_cursor(NEXT, objects[-1].id)
+        if order_id is not None and (has_more or forward):
+            prev_cursor = encode_cursor(PREV, objects[0].id)
+    return objects, next_cursor, prev_cursor
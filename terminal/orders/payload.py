@@ -0,0 +1,85 @@
+import ast
+import json
+
+
+class PayloadError(ValueError):
+    """ Данные заказа из запроса не разобрались или не прошли проверку - ответ 400 """
+    pass
+
+
+def parse_payload(raw):
+    """ JSON, для старых клиентов - литерал Python (repr списка словарей). Без eval: код из запроса не выполняется """
+    if isinstance(raw, (list, dict)):
+        return raw
+    if not isinstance(raw, str):
+        raise PayloadError('ожидается строка')
+    try:
+        return json.loads(raw)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(raw)
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        raise PayloadError('не удалось разобрать')
+
+
+def _list_of_dicts(raw, name):
+    items = parse_payload(raw)
+    if not isinstance(items, (list, tuple)) or not all(isinstance(item, dict) for item in items):
+        raise PayloadError('%s: ожидается список объектов' % name)
+    return list(items)
+
+
+def _int(value, name):
+    if isinstance(value, bool):
+        raise PayloadError('%s: ожидается число' % name)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise PayloadError('%s: ожидается число' % name)
+
+
+def parse_services(raw):
+    """ Строки заказа: [{'id': услуга, 'department_id': отдел, 'count': количество}, ...] """
+    services = _list_of_dicts(raw, 'services')
+    for line in services:
+        line['id'] = _int(line.get('id'), 'services.id')
+        line['department_id'] = _int(line.get('department_id'), 'services.department_id')
+        count = line.get('count')
+        if count is not None and count != '':
+            if isinstance(count, bool):
+                raise PayloadError('services.count: ожидается число')
+            try:
+                float(count)
+            except (TypeError, ValueError):
+                raise PayloadError('services.count: ожидается число')
+    return services
+
+
+def parse_fields(raw):
+    """ Значения кастомных полей: [{'id': поле, 'value': строка, число или объект}, ...] """
+    fields = _list_of_dicts(raw, 'fields')
+    for field in fields:
+        if field.get('id'):
+            field['id'] = _int(field.get('id'), 'fields.id')
+        if not isinstance(field.get('value'), (str, int, float, bool, dict, list, type(None))):
+            raise PayloadError('fields.value: неверный тип')
+    return fields
+
+
+def dict_value(value):
+    """
+    Значение поля-объекта (адрес и т.п.) для value_json: словарь или его repr, как их раньше распознавал eval.
+    Для остальных значений - None
+    """
+    if isinstance(value, dict):
+        return value
+    if not isinstance(value, str) or not value.lstrip().startswith('{'):
+        return None
+    for text in (value, value.replace('Decimal', '')):
+        try:
+            parsed = ast.literal_eval(text)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+        return parsed if isinstance(parsed, dict) else None
+    return None
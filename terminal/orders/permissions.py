@@ -0,0 +1,82 @@
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
+
+from orders.models import Order
+
+# Права юзера кешируются в Redis ненадолго: привязки к отделам и магазинам меняются редко,
+# а проверки идут на каждый запрос к заказам
+ACCESS_CACHE_TIMEOUT = 60
+
+
+class OrderAccess:
+    """
+    Права юзера на заказы и магазины: id отделов и магазинов посчитаны один раз на запрос.
+    Юзер должен быть прикреплен к отделу (для КМ - 0, СМ - 1, АО - 2) или магазину (для АМ - 3, АСМ - 4)
+    """
+
+    def __init__(self, is_terminal_man, department_ids, store_ids):
+        self.is_terminal_man = is_terminal_man
+        self.department_ids = department_ids
+        self.store_ids = store_ids
+
+    @staticmethod
+    def cache_key(user_id):
+        return 'orders:access:%s' % user_id
+
+    @classmethod
+    def for_user(cls, user):
+        """ Один раз на запрос (сохраняется на объекте юзера), между запросами - из Redis """
+        access = getattr(user, '_order_access', None)
+        if access is not None:
+            return access
+
+        data = cache.get(cls.cache_key(user.id))
+        if data is None:
+            data = cls.load(user)
+            cache.set(cls.cache_key(user.id), data, ACCESS_CACHE_TIMEOUT)
+        access = cls(**data)
+        user._order_access = access
+        return access
+
+    @staticmethod
+    def load(user):
+        # отделы нужны и администратору терминала: список заказов магазина фильтруется по ним для всех ролей
+        department_ids = frozenset(d.id for d in user.departments)
+        if user.is_terminal_man:
+            store_ids = frozenset()
+        elif user.is_acm or user.is_com:
+            store_ids = frozenset(s.id for s in user.stores)
+        else:
+            store_ids = frozenset([user.store.id]) if user.store else frozenset()
+        return {'is_terminal_man': user.is_terminal_man, 'department_ids': department_ids, 'store_ids': store_ids}
+
+    @classmethod
+    def invalidate(cls, user_id):
+        cache.delete(cls.cache_key(user_id))
+
+    @classmethod
+    def invalidate_many(cls, users_id):
+        cache.delete_many([cls.cache_key(user_id) for user_id in set(users_id)])
+
+    def has_order(self, order):
+        if self.is_terminal_man:
+            return True
+        return any(d.id in self.department_ids for d in order.departments.all())
+
+    def has_department(self, department_id):
+        return self.is_terminal_man or int(department_id) in self.department_ids
+
+    def has_store(self, store_id):
+        if self.is_terminal_man:
+            return True
+        return str(store_id) in {str(i) for i in self.store_ids}
+
+    def orders_filter(self, outer_ref='id'):
+        """ Условие доступа к заказу для запроса (EXISTS по отделам заказа) """
+        return Exists(Order.departments.through.objects.filter(
+            order_id=OuterRef(outer_ref), clientstoredepartment_id__in=self.department_ids))
+
+    def filter_orders(self, orders):
+        if self.is_terminal_man:
+            return orders
+        return orders.filter(self.orders_filter())
@@ -0,0 +1,141 @@
+import uuid
+
+import numpy as np
+from django.core.cache import cache
+
+from services.models import ServiceDiscount
+
+RELATIVE_DISCOUNT = 1
+ABSOLUTE_DISCOUNT = 2
+
+# Версия правил скидок в Redis, общая для всех процессов. Меняется при любом изменении ServiceDiscount
+DISCOUNTS_VERSION_KEY = 'orders:service_discounts:version'
+
+# Правила скидок в памяти процесса, актуальны пока совпадает версия
+_discount_rules = {'version': None, 'rules': {}}
+
+
+def invalidate_discount_rules():
+    cache.set(DISCOUNTS_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def discount_rules():
+    """
+    Все скидки по услугам: {service_id: {'absolute': [(id, value)], 'relative': [(id, value)]}}.
+    Берутся из памяти процесса, из базы перечитываются только после смены версии в Redis
+    """
+    version = cache.get(DISCOUNTS_VERSION_KEY)
+    if version is None:
+        cache.add(DISCOUNTS_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(DISCOUNTS_VERSION_KEY)
+    if version != _discount_rules['version']:
+        rules = {}
+        for sd in ServiceDiscount.objects.filter(discount_type_id__in=[RELATIVE_DISCOUNT, ABSOLUTE_DISCOUNT]):
+            d = rules.setdefault(sd.service_id, {'absolute': [], 'relative': []})
+            d['absolute' if sd.discount_type_id == ABSOLUTE_DISCOUNT else 'relative'].append((sd.id, sd.value))
+        _discount_rules.update(version=version, rules=rules)
+    return _discount_rules['rules']
+
+
+def load_discounts(service_ids):
+    """ Скидки по услугам из кеша правил, без запросов в базу """
+    rules = discount_rules()
+    return {service_id: rules[service_id] for service_id in set(service_ids) if service_id in rules}
+
+
+def _services_discounts(services, discounts):
+    """
+    Скидки, применимые к набору услуг, в том порядке, в каком их применял Order.price:
+    абсолютные по id, относительные по service_id (затем по id)
+    """
+    absolute = []
+    relative = []
+    for service_id in sorted(set(s.id for s in services)):
+        d = discounts.get(service_id)
+        if d:
+            absolute += d['absolute']
+            relative += [(service_id, sd_id, value) for sd_id, value in d['relative']]
+    absolute.sort(key=lambda item: item[0])
+    relative.sort(key=lambda item: (item[0], item[1]))
+    return [value for _, value in absolute], [value for _, _, value in relative]
+
+
+def _padded(rows, fill):
+    width = max([len(r) for r in rows] + [0])
+    m = np.full((len(rows), width), fill, dtype=np.float64)
+    for i, r in enumerate(rows):
+        m[i, :len(r)] = r
+    return m
+
+
+def _apply_relative(x, relatives):
+    """
+    Относительные скидки перемножаются по столбцам: внутри заказа порядок умножений тот же, что и в цикле,
+    поэтому результат совпадает с поштучным расчетом до бита
+    """
+    m = _padded(relatives, 1.0)
+    for j in range(m.shape[1]):
+        x *= m[:, j]
+    return [round(v - 0.001, 2) for v in x.tolist()]
+
+
+def orders_prices(orders_invoices, signedup=False, contractor=False, aggregator_id=None, discounts=None):
+    """
+    Стоимость пачки заказов, то же, что Order.price для каждого заказа.
+    orders_invoices - список списков инвойсов (по одному на заказ, с загруженными service)
+    """
+    if discounts is None:
+        discounts = load_discounts(oi.service_id for invoices in orders_invoices for oi in invoices)
+
+    counts = []
+    costs = []
+    absolutes = []
+    relatives = []
+    for invoices in orders_invoices:
+        if signedup:
+            if invoices and invoices[0].contractor_id is not None:
+                lines = [(i.count, float(i.cost_signedup)) for i in invoices if i.service.service_type_id == 1 and i.cost_signedup]
+            else:
+                lines = [(i.count, float(i.cost)) for i in invoices if i.service.service_type_id == 1]
+        elif contractor:
+            lines = [(i.count, float(i.cost_contractor)) for i in invoices
+                     if i.service.service_type_id == 1 and i.cost_contractor and i.contractor_id != aggregator_id]
+        else:
+            lines = [(i.count, float(i.cost)) for i in invoices if i.service.service_type_id == 1]
+        counts.append([c for c, _ in lines])
+        costs.append([c for _, c in lines])
+        absolute, relative = _services_discounts([i.service for i in invoices], discounts)
+        absolutes.append([float(v) for v in absolute])
+        relatives.append([float(v) for v in relative])
+
+    # Суммируем primary * count по столбцам, последовательно, как sum() по списку
+    lines = _padded(counts, 0.0) * _padded(costs, 0.0)
+    x = np.zeros(len(orders_invoices), dtype=np.float64)
+    for j in range(lines.shape[1]):
+        x += lines[:, j]
+    # Прибавляем все discount типа absolute
+    m = _padded(absolutes, 0.0)
+    for j in range(m.shape[1]):
+        x += m[:, j]
+    # Умножаем на discount типа relative в порядке services_service_id
+    return _apply_relative(x, relatives)
+
+
+def invoices_costs(items, discounts=None):
+    """
+    Стоимость строк заказа со скидками, то же, что OrderInvoice.get_cost для каждой пары.
+    items - список пар (услуги заказа, цена строки)
+    """
+    if discounts is None:
+        discounts = load_discounts(s.id for services, _ in items for s in services)
+
+    x = []
+    relatives = []
+    for services, cost in items:
+        absolute, relative = _services_discounts(services, discounts)
+        # абсолютные скидки складываются с ценой в ее собственном типе (Decimal), как в get_cost
+        for value in absolute:
+            cost += value
+        x.append(float(cost))
+        relatives.append([float(v) for v in relative])
+    return _apply_relative(np.array(x, dtype=np.float64), relatives)
@@ -0,0 +1,306 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+
+from clients.models import ClientStore, ClientStoreDepartment
+from orders.cache import bump_clients, bump_departments, bump_orders, bump_stores
+from orders.catalog import invalidate_catalog
+from orders.deferred import defer, run_pending
+from orders.events import publish_order_event
+from orders.models import (Feedback, Order, OrderCustomField, OrderCustomFieldValue, OrderDraft, OrderExportRow, OrderInvoice,
+                           OrderOutbox, OrderPublish, OrderSearchIndex, OrderStatusLog)
+from orders.permissions import OrderAccess
+from orders.pricing import invalidate_discount_rules
+from services.models import Service
+
+
+_state = threading.local()
+
+
+@contextmanager
+def order_signals_suppressed():
+    """
+    Внутри блока обработчики заказов ничего не пересобирают. Для пакетных операций (удаление сотен заказов),
+    где производные данные удаляются каскадом или обновляются явно
+    """
+    previous = suppressed()
+    _state.suppressed = True
+    try:
+        yield
+    finally:
+        # вложенный блок не должен снимать подавление внешнего
+        _state.suppressed = previous
+
+
+def suppressed():
+    return getattr(_state, 'suppressed', False)
+
+
+def rebuild_export_row(order_id, order=None):
+    """
+    Строка выгрузки пересобирается после коммита, когда все изменения заказа уже в базе, одна пересборка
+    на все изменения заказов за транзакцию. Строки есть только у выполненных заказов: если заказ под рукой
+    и он не выполнен и не был выполнен при загрузке, пересобирать нечего
+    """
+    if not order_id or suppressed():
+        return
+    if order is not None and 4 not in (order.status_id, getattr(order, '_loaded_status_id', None)):
+        return
+    defer('orders_export_rows', export_rows_rebuilt, [order_id])
+
+
+def export_rows_rebuilt(orders_id):
+    # строка выгрузки берет даты с заказа - отложенный пересчет дат должен пройти раньше
+    run_pending('orders_log_dates')
+    OrderExportRow.rebuild(orders_id)
+
+
+def rebuild_search_index(order_id):
+    if order_id and not suppressed():
+        defer('orders_search_index', OrderSearchIndex.rebuild, [order_id])
+
+
+def cached_order(instance):
+    """ Заказ, уже загруженный на связанном объекте (create(order=o)), без запроса; иначе None """
+    field = instance._meta.get_field('order')
+    return field.get_cached_value(instance) if field.is_cached(instance) else None
+
+
+@receiver(post_init, sender=Order)
+def order_loaded(sender, instance, **kwargs):
+    # через __dict__, чтобы .only() без status не давал лишний запрос
+    instance._loaded_status_id = instance.__dict__.get('status_id')
+
+
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, **kwargs):
+    rebuild_export_row(instance.id, instance)
+    rebuild_search_index(instance.id)
+    instance._loaded_status_id = instance.status_id
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def order_changed(sender, instance, **kwargs):
+    if not suppressed():
+        bump_stores([instance.store_id], [instance.id])
+
+
+@receiver(post_save, sender=OrderStatusLog)
+@receiver(post_delete, sender=OrderStatusLog)
+@receiver(post_save, sender=Feedback)
+@receiver(post_delete, sender=Feedback)
+@receiver(post_save, sender=OrderPublish)
+@receiver(post_save, sender=OrderDraft)
+@receiver(post_save, sender=OrderCustomFieldValue)
+@receiver(post_delete, sender=OrderCustomFieldValue)
+@receiver(post_save, sender=OrderOutbox)
+def order_list_data_changed(sender, instance, **kwargs):
+    """ Все, что попадает в список заказов, меняет поколение магазина заказа """
+    if not suppressed():
+        bump_orders([instance.order_id])
+
+
+@receiver(post_save, sender=OrderStatusLog)
+def order_status_logged(sender, instance, created, **kwargs):
+    if created and not suppressed():
+        publish_order_event(instance.order_id, {'type': 'status', 'status_id': instance.status_id})
+
+
+@receiver(post_init, sender=Feedback)
+def feedback_loaded(sender, instance, **kwargs):
+    instance._was_completed = instance.completed
+
+
+@receiver(post_save, sender=Feedback)
+def feedback_saved(sender, instance, **kwargs):
+    # событие только при заполнении отзыва, а не на каждое сохранение
+    if instance.completed and not instance._was_completed and not suppressed():
+        publish_order_event(instance.order_id, {'type': 'feedback'})
+    instance._was_completed = instance.completed
+
+
+@receiver(post_save, sender='aidu.ScheduleTask')
+@receiver(post_delete, sender='aidu.ScheduleTask')
+def order_schedule_changed(sender, instance, **kwargs):
+    if not suppressed():
+        bump_orders([instance.task_id])
+
+
+@receiver(m2m_changed, sender=Order.departments.through)
+def order_departments_changed(sender, instance, action, pk_set=None, **kwargs):
+    if action.startswith('post_') and not suppressed():
+        if isinstance(instance, Order):
+            bump_stores([instance.store_id], [instance.id])
+        else:
+            bump_orders(pk_set or [])
+
+
+@receiver(post_save, sender=OrderDraft)
+@receiver(post_delete, sender=OrderDraft)
+@receiver(post_save, sender=OrderPublish)
+@receiver(post_delete, sender=OrderPublish)
+@receiver(post_save, sender=OrderStatusLog)
+@receiver(post_delete, sender=OrderStatusLog)
+def order_dates_changed(sender, instance, created=False, **kwargs):
+    """
+    Запасной путь для дат на заказе (created_at, published_at, executor_found_at, completed_at):
+    места, где пишутся черновики, публикации и логи, ставят их сами, здесь - все остальные.
+    Пересчет после коммита, один на все заказы транзакции
+    """
+    if suppressed() or (sender is OrderStatusLog and instance.status_id not in [3, 4]):
+        return
+    if created:
+        # новая запись не первая, если дата на уже загруженном заказе стоит - пересчитывать нечего
+        order = cached_order(instance)
+        if sender is OrderDraft:
+            name = 'created_at'
+        elif sender is OrderPublish:
+            name = 'published_at'
+        else:
+            name = 'executor_found_at' if instance.status_id == 3 else 'completed_at'
+        if order is not None and getattr(order, name) is not None:
+            return
+    defer('orders_log_dates', Order.sync_orders_log_dates, [instance.order_id])
+
+
+@receiver(post_save, sender=OrderCustomFieldValue)
+@receiver(post_delete, sender=OrderCustomFieldValue)
+def order_field_value_changed(sender, instance, **kwargs):
+    rebuild_search_index(instance.order_id)
+
+
+@receiver(post_save, sender=OrderInvoice)
+@receiver(post_delete, sender=OrderInvoice)
+@receiver(post_save, sender=Feedback)
+@receiver(post_delete, sender=Feedback)
+@receiver(post_save, sender=OrderStatusLog)
+@receiver(post_delete, sender=OrderStatusLog)
+@receiver(post_save, sender=OrderDraft)
+@receiver(post_save, sender=OrderPublish)
+def order_related_changed(sender, instance, **kwargs):
+    rebuild_export_row(instance.order_id, cached_order(instance))
+
+
+def catalog_invalidated():
+    # одна новая версия каталога на транзакцию, сколько бы услуг и отделов в ней ни менялось
+    defer('orders_catalog', lambda items: invalidate_catalog(), [True])
+
+
+@receiver(post_save, sender='services.ServiceDiscount')
+@receiver(post_delete, sender='services.ServiceDiscount')
+def service_discount_changed(sender, **kwargs):
+    # версию меняем после коммита, иначе другой процесс может успеть перечитать старые скидки под новой версией
+    transaction.on_commit(invalidate_discount_rules)
+    # скидки входят в сериализацию услуг каталога
+    catalog_invalidated()
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+@receiver(post_save, sender=ClientStoreDepartment)
+@receiver(post_delete, sender=ClientStoreDepartment)
+@receiver(post_save, sender='clients.ClientStore')
+@receiver(post_delete, sender='clients.ClientStore')
+@receiver(post_save, sender=OrderCustomField)
+@receiver(post_delete, sender=OrderCustomField)
+@receiver(post_save, sender='clients.Client')
+def catalog_changed(sender, **kwargs):
+    # каталог входит и в ETag карточки заказа: там же названия магазина и клиента
+    catalog_invalidated()
+
+
+@receiver(post_save, sender=ClientStoreDepartment)
+@receiver(post_save, sender=ClientStore)
+@receiver(post_save, sender='clients.Client')
+def orders_titles_changed(sender, instance, created, **kwargs):
+    """ Названия отдела, магазина и клиента попадают в закешированные списки заказов """
+    if created:
+        return
+    if sender is ClientStoreDepartment:
+        bump_departments([instance.id])
+    elif sender is ClientStore:
+        bump_stores([instance.id])
+    else:
+        bump_clients([instance.id])
+
+
+@receiver(m2m_changed, sender=Service.departments.through)
+@receiver(m2m_changed, sender=ClientStoreDepartment.employees.through)
+def catalog_links_changed(sender, action, **kwargs):
+    # услуги отделов и сотрудники отделов: от них зависит, какие отделы и услуги видит юзер
+    if action.startswith('post_'):
+        catalog_invalidated()
+
+
+def access_changed(users_id):
+    # права юзеров (OrderAccess в Redis) сбрасываются после коммита, иначе их успеют закешировать старыми
+    defer('orders_access', OrderAccess.invalidate_many, users_id)
+
+
+def _user_field(through):
+    return next(f for f in through._meta.concrete_fields if f.is_relation and f.related_model is get_user_model())
+
+
+def _linked_users(through, instance):
+    """ Юзеры, привязанные к магазину или отделу через промежуточную таблицу """
+    user_field = _user_field(through)
+    field = next(f for f in through._meta.concrete_fields
+                 if f.is_relation and f is not user_field and isinstance(instance, f.related_model))
+    return list(through.objects.filter(**{field.attname: instance.pk}).values_list(user_field.attname, flat=True))
+
+
+def employee_links():
+    """ M2M между юзерами и магазинами/отделами (сотрудники отделов, магазины АМ/АСМ): от них зависят права на заказы """
+    user_model = get_user_model()
+    throughs = set()
+    for model in (user_model, ClientStore, ClientStoreDepartment):
+        for field in model._meta.many_to_many:
+            linked = {model, field.related_model}
+            if user_model in linked and linked & {ClientStore, ClientStoreDepartment}:
+                throughs.add(field.remote_field.through)
+    return throughs
+
+
+def employee_links_changed(sender, instance, action, model, pk_set=None, **kwargs):
+    if isinstance(instance, get_user_model()):
+        if action.startswith('post_'):
+            access_changed([instance.pk])
+    elif action == 'pre_clear':
+        # после clear() связей уже нет - запоминаем, кого он затронет
+        instance._access_users = _linked_users(sender, instance)
+    elif action == 'post_clear':
+        access_changed(getattr(instance, '_access_users', []))
+    elif action.startswith('post_') and model is get_user_model():
+        access_changed(pk_set or [])
+
+
+for through in employee_links():
+    m2m_changed.connect(employee_links_changed, sender=through, dispatch_uid='orders_access_%s' % through._meta.label)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved(sender, instance, created, **kwargs):
+    # роль, магазин юзера
+    if not created:
+        access_changed([instance.pk])
+
+
+@receiver(pre_delete, sender=ClientStoreDepartment)
+@receiver(pre_delete, sender=ClientStore)
+def employee_links_deleting(sender, instance, **kwargs):
+    # связи удаляются каскадом без m2m_changed
+    instance._access_users = [user_id for through in employee_links() if any(
+        f.is_relation and isinstance(instance, f.related_model) for f in through._meta.concrete_fields)
+        for user_id in _linked_users(through, instance)]
+
+
+@receiver(post_delete, sender=ClientStoreDepartment)
+@receiver(post_delete, sender=ClientStore)
+def employee_links_deleted(sender, instance, **kwargs):
+    access_changed(getattr(instance, '_access_users', []))
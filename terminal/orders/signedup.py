@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Таймауты запросов в сайнап: подключение и ожидание ответа, сек
+SIGNEDUP_CONNECT_TIMEOUT = getattr(settings, 'SIGNEDUP_CONNECT_TIMEOUT', 3.05)
+SIGNEDUP_READ_TIMEOUT = getattr(settings, 'SIGNEDUP_READ_TIMEOUT', 15)
+# Повторы только на ошибках подключения: запрос до сайнапа не дошел, повтор POST безопасен
+SIGNEDUP_CONNECT_RETRIES = getattr(settings, 'SIGNEDUP_CONNECT_RETRIES', 2)
+SIGNEDUP_POOL_SIZE = getattr(settings, 'SIGNEDUP_POOL_SIZE', 10)
+
+# Предохранитель: после N ошибок подряд запросы не отправляются COOLDOWN секунд, затем пробный запрос
+BREAKER_FAILURES = getattr(settings, 'SIGNEDUP_BREAKER_FAILURES', 5)
+BREAKER_COOLDOWN = getattr(settings, 'SIGNEDUP_BREAKER_COOLDOWN', 30)
+
+# Метрики по эндпоинтам копятся в Redis почасовыми корзинами
+METRICS_KEY = 'orders:signedup:metrics:%s:%s:%s'
+METRICS_TIMEOUT = 60 * 60 * 48
+
+
+class SignedUpUnavailable(Exception):
+    """ Сайнап недоступен, предохранитель разомкнут - запрос не отправлялся """
+    pass
+
+
+_local = {'pid': None, 'session': None}
+_breaker = {'failures': 0, 'opened': None}
+_lock = threading.Lock()
+
+
+def session():
+    """ Одна сессия с пулом соединений на процесс (после fork воркера django-q создается заново) """
+    pid = os.getpid()
+    if _local['pid'] != pid:
+        s = requests.Session()
+        retry = Retry(total=SIGNEDUP_CONNECT_RETRIES, connect=SIGNEDUP_CONNECT_RETRIES, read=0, status=0,
+                      redirect=0, backoff_factor=0.3, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=SIGNEDUP_POOL_SIZE, max_retries=retry)
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        _local.update(pid=pid, session=s)
+    return _local['session']
+
+
+def _breaker_allows():
+    with _lock:
+        if _breaker['opened'] is None:
+            return True
+        if time.monotonic() - _breaker['opened'] >= BREAKER_COOLDOWN:
+            # полуоткрытое состояние: пропускаем один пробный запрос
+            _breaker['opened'] = time.monotonic()
+            return True
+        return False
+
+
+def _breaker_result(ok):
+    with _lock:
+        if ok:
+            _breaker.update(failures=0, opened=None)
+        else:
+            _breaker['failures'] += 1
+            if _breaker['failures'] >= BREAKER_FAILURES:
+                _breaker['opened'] = time.monotonic()
+
+
+def _incr(key, delta):
+    cache.add(key, 0, METRICS_TIMEOUT)
+    cache.incr(key, delta)
+
+
+def _record(endpoint, elapsed, ok):
+    hour = time.strftime('%Y%m%d%H', time.gmtime())
+    try:
+        _incr(METRICS_KEY % (endpoint, hour, 'calls'), 1)
+        _incr(METRICS_KEY % (endpoint, hour, 'ms'), int(elapsed * 1000))
+        if not ok:
+            _incr(METRICS_KEY % (endpoint, hour, 'errors'), 1)
+    except:
+        # метрики не должны ломать запрос
+        pass
+
+
+def metrics(endpoint, hour=None):
+    """ Вызовы, ошибки, доля ошибок и средняя задержка эндпоинта за час (по умолчанию - текущий, UTC) """
+    hour = hour or time.strftime('%Y%m%d%H', time.gmtime())
+    values = cache.get_many([METRICS_KEY % (endpoint, hour, name) for name in ('calls', 'errors', 'ms')])
+    calls = values.get(METRICS_KEY % (endpoint, hour, 'calls')) or 0
+    errors = values.get(METRICS_KEY % (endpoint, hour, 'errors')) or 0
+    ms = values.get(METRICS_KEY % (endpoint, hour, 'ms')) or 0
+    return {
+        'calls': calls,
+        'errors': errors,
+        'error_rate': errors / calls if calls else 0,
+        'avg_ms': ms / calls if calls else 0,
+    }
+
+
+def post(endpoint, data, headers=None):
+    """
+    POST в сайнап (endpoint - путь от SIGNEDUP_API_SITE, например 'api/specialtasks/status/').
+    Ответ возвращается как есть, включая 4xx/5xx. Сетевые ошибки - requests.RequestException,
+    при разомкнутом предохранителе - SignedUpUnavailable
+    """
+    if not _breaker_allows():
+        _record(endpoint, 0, False)
+        raise SignedUpUnavailable(endpoint)
+
+    started = time.monotonic()
+    try:
+        r = session().post(settings.SIGNEDUP_API_SITE + endpoint, data=data, headers=headers,
+                           timeout=(SIGNEDUP_CONNECT_TIMEOUT, SIGNEDUP_READ_TIMEOUT))
+    except requests.RequestException:
+        _breaker_result(False)
+        _record(endpoint, time.monotonic() - started, False)
+        raise
+
+    # 4xx - ответ сайнапа по существу запроса, предохранитель размыкают только сбои сервера
+    ok = r.status_code < 500
+    _breaker_result(ok)
+    _record(endpoint, time.monotonic() - started, ok and r.status_code < 400)
+    return r
@@ -0,0 +1,40 @@
+import json
+import traceback
+
+from django.core.files.storage import default_storage
+
+from api.models import Log
+from orders import outbox
+from orders.models import OrderXLS
+from orders.xls import export_orders_xls
+
+
+def orders_xls_export(xls_id):
+    """ Фоновая выгрузка заказов в xlsx (django-q) """
+    xls = OrderXLS.objects.select_related('user').get(id=xls_id)
+    try:
+        export_orders_xls(xls.user, json.loads(xls.params), xls=xls)
+    except:
+        Log.objects.create(category='orders', function='orders_xls_export', title='xls_id=%s' % xls_id,
+                           text=traceback.format_exc())
+        OrderXLS.objects.filter(id=xls_id).update(status=OrderXLS.STATUS_FAILED)
+
+
+def delete_feedback_images(names):
+    """ Удаление файлов фотографий отзывов из хранилища после удаления заказов """
+    for name in names:
+        try:
+            default_storage.delete(name)
+        except:
+            Log.objects.create(category='orders', function='delete_feedback_images', title=name,
+                               text=traceback.format_exc())
+
+
+def deliver_order_outbox(outbox_id):
+    """ Отправка опубликованного заказа в сайнап (django-q), повторы планируются самой задачей """
+    outbox.deliver_order_outbox(outbox_id)
+
+
+def retry_order_outbox():
+    """ Периодическая задача (django-q Schedule): подбирает зависшие отправки в сайнап """
+    outbox.retry_pending_outbox()
@@ -1,3 +1,494 @@
-from django.test import TestCase
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import SkipTest, mock
+from urllib.parse import parse_qs
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+from django_redis import get_redis_connection
+from rest_framework.test import APIClient
+
+from aidu.models import ScheduleTask
+from clients.models import Client, ClientStore, ClientStoreDepartment
+from orders import cache as orders_cache, events, signedup, views
+from orders.builder import create_order, load_custom_fields
+from orders.card import load_order
+from orders.models import (Customer, Feedback, Order, OrderCustomField, OrderCustomFieldTypes, OrderCustomFieldValue, OrderDraft,
+                           OrderInvoice, OrderOutbox, OrderPublish, OrderSearchIndex, OrderStatusLog, OrderXLS)
+from orders.permissions import OrderAccess
+from orders.outbox import deliver_order_outbox, enqueue_order_publish, retry_pending_outbox
+from orders.xls import enqueue_orders_xls, orders_xls_params
+from orders.pricing import discount_rules
+from services.models import Service
+
+# для тестов view через тестовый клиент (ROOT_URLCONF='orders.tests')
+urlpatterns = [
+    path('orders/', views.orders_view),
+    path('orders/events/', views.orders_events),
+]
+
+
+# кеш в памяти процесса: тестам заказов Redis не нужен (кроме потока событий - OrderEventsTest)
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def create_user(username):
+    return get_user_model().objects.create(username=username)
+
+
+def create_store(title='Магазин'):
+    """ Торговая точка со своим клиентом и городом (город нужен сериализации и отправке в сайнап) """
+    client = Client.objects.create(title='Клиент')
+    city = ClientStore.city.field.related_model.objects.create(title='Москва', city_id=1, country_title='Россия')
+    return ClientStore.objects.create(client=client, city=city, title=title)
+
+
+def create_department(store, title):
+    return ClientStoreDepartment.objects.create(store=store, title=title)
+
+
+def create_service(store, title):
+    return Service.objects.create(store=store, title=title, cost=100, cost_signedup=80, unit_name='шт')
+
+
+def create_custom_field(client, field_name):
+    field_type, _ = OrderCustomFieldTypes.objects.get_or_create(title='text')
+    return OrderCustomField.objects.create(client=client, field_type=field_type, field_name=field_name)
+
+
+def create_test_order(store, status_id, **kwargs):
+    return Order.objects.create(store=store, status_id=status_id, phone='+79990000000', **kwargs)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OrdersTestCase(TestCase):
+    """ Общая база тестов заказов: поколения, права и цены кешируются в locmem, который чистится перед тестом """
+
+    def setUp(self):
+        cache.clear()
+
+
+class SerializeManyTest(OrdersTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = create_user('serialize')
+        store = create_store()
+        departments = [create_department(store, 'Отдел 1'), create_department(store, 'Отдел 2')]
+        address = create_custom_field(store.client, 'address')
+        cls.orders_id = []
+        for i in range(3):
+            o = create_test_order(store, i + 1, created_at=timezone.now(), created_by=user)
+            o.departments.set(departments[:i + 1])
+            OrderCustomFieldValue.objects.create(order=o, custom_field=address, value='адрес %s' % i)
+            cls.orders_id.append(o.id)
+        first, second = cls.orders_id[:2]
+        Feedback.objects.create(order_id=first, uid='first', adequacy=5, decency=4, punctuality=3,
+                                executor_fio='Исполнитель', executor_id=1)
+        Feedback.objects.create(order_id=first, uid='first-2', adequacy=1, decency=1, punctuality=1)
+        ScheduleTask.objects.create(task_id=second)
+
+    def orders(self, orders_id=None):
+        return list(Order.objects.filter(id__in=orders_id or self.orders_id).order_by('id'))
+
+    def test_same_as_serialize(self):
+        expected = [o.serialize() for o in self.orders()]
+        orders = self.orders()
+        # отделы, статусы, магазины, клиенты, города, авторы, отзывы, расписания - по запросу на страницу
+        with self.assertNumQueries(8):
+            data = Order.serialize_many(orders)
+        self.assertEqual(data, expected)
+
+    def test_with_address(self):
+        orders = self.orders()
+        with self.assertNumQueries(9):
+            data = Order.serialize_many(orders, with_address=True)
+        self.assertEqual([d['address'] for d in data], ['адрес 0', 'адрес 1', 'адрес 2'])
+
+    def test_queries_do_not_grow(self):
+        counts = []
+        for orders_id in (self.orders_id[:1], self.orders_id):
+            orders = self.orders(orders_id)
+            with CaptureQueriesContext(connection) as queries:
+                Order.serialize_many(orders)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+
+class LoadOrderTest(OrdersTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = create_user('card')
+        store = create_store()
+        o = create_test_order(store, 2, created_at=timezone.now(), created_by=user, published_at=timezone.now(), publisher=user)
+        o.departments.set([create_department(store, 'Отдел 1'), create_department(store, 'Отдел 2')])
+        for i in range(3):
+            OrderInvoice.objects.create(order=o, service=create_service(store, 'Услуга %s' % i), count=1)
+            OrderCustomFieldValue.objects.create(order=o, custom_field=create_custom_field(store.client, 'Поле %s' % i),
+                                                 value='значение')
+        for status_id in (1, 2):
+            OrderStatusLog.objects.create(order=o, status_id=status_id)
+        OrderDraft.objects.create(order=o, employee=user)
+        OrderPublish.objects.create(order=o, employee=user)
+        Feedback.objects.create(order=o, uid='card', adequacy=5, decency=5, punctuality=5, executor_id=7)
+        cls.order_id = o.id
+
+    def test_queries(self):
+        # заказ, отделы, публикация, отзыв, инвойсы, значения полей, логи, отправка в сайнап
+        with self.assertNumQueries(8):
+            o = load_order(self.order_id)
+        # все, что читает карточка, уже загружено
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(o.publish)
+            self.assertEqual(o.executor_id, 7)
+            self.assertIsNotNone(o.feedback_obj)
+            o.date, o.fio, o.publish_fio
+            o.status.title, o.store.client.title, o.store.city.title
+            [d.title for d in o.departments.all()]
+            [oi.service.id for oi in o.card_invoices]
+            [v.custom_field.field_type for v in o.card_field_values]
+            [log.status.title for log in o.card_logs]
+        self.assertEqual((len(o.card_invoices), len(o.card_field_values), len(o.card_logs)), (3, 3, 2))
+
+    def test_prefetched_attributes(self):
+        o = Order.objects.get(id=self.order_id)
+        # без загруженного - по запросу на каждое свойство
+        with self.assertNumQueries(3):
+            draft, publish, feedback = o.draft, o.publish, o.feedback_obj
+        o._draft, o._publish, o._feedback = draft, publish, feedback
+        with self.assertNumQueries(0):
+            self.assertEqual((o.draft, o.publish, o.feedback_obj), (draft, publish, feedback))
+        # None тоже загруженное значение: у заказа нет публикации - запроса нет
+        o._publish = None
+        with self.assertNumQueries(0):
+            self.assertIsNone(o.publish)
+
+class CreateOrderTest(OrdersTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('create')
+        cls.store = create_store()
+        cls.customer = Customer.objects.create(client=cls.store.client)
+        cls.departments = [create_department(cls.store, 'Отдел %s' % i) for i in range(3)]
+        cls.services = [create_service(cls.store, 'Услуга %s' % i) for i in range(3)]
+        cls.custom_fields = [create_custom_field(cls.store.client, 'Поле %s' % i) for i in range(3)]
+
+    def payload(self, count):
+        services_data = [{'id': s.id, 'count': 2, 'department_id': d.id}
+                         for s, d in zip(self.services[:count], self.departments)]
+        fields = [{'id': f.id, 'value': 'значение %s' % f.id} for f in self.custom_fields[:count]]
+        return services_data, self.services[:count], fields, load_custom_fields(fields)
+
+    def create(self, services_data, services, fields, custom_fields):
+        return create_order(self.store, self.customer, self.user, '+79990000000', False, '2030-01-01', services_data,
+                            services, fields, custom_fields)
+
+    def test_queries(self):
+        # правила скидок читаются из памяти процесса, первый раз - из базы
+        discount_rules()
+        for count in (1, 3):
+            payload = self.payload(count)
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                with self.assertNumQueries(6):
+                    o = self.create(*payload)
+            # индекс поиска, поколения кеша и событие - по одному колбэку, сколько бы сигналов ни было
+            self.assertEqual(len(callbacks), 3)
+            self.assertEqual(OrderInvoice.objects.filter(order=o).count(), count)
+            self.assertEqual(o.departments.count(), count)
+            self.assertTrue(OrderSearchIndex.objects.filter(order=o).exists())
+
+    def test_dates(self):
+        o = self.create(*self.payload(1))
+        o.refresh_from_db()
+        self.assertEqual(o.created_by_id, self.user.id)
+        self.assertEqual(o.created_at, OrderDraft.objects.get(order=o).created)
+
+    def test_unknown_custom_field(self):
+        with self.assertRaises(OrderCustomField.DoesNotExist):
+            load_custom_fields([{'id': self.custom_fields[0].id}, {'id': self.custom_fields[-1].id + 1000}])
+        with self.assertRaises(OrderCustomField.DoesNotExist):
+            load_custom_fields([{'value': 'без поля'}])
+
+
+@override_settings(ROOT_URLCONF='orders.tests')
+class OrdersViewCacheTest(OrdersTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('list')
+        cls.store = create_store()
+        # выполнен, но дата выполнения еще не проставлена - ее ставит пересчет дат из логов после коммита
+        cls.order = create_test_order(cls.store, 4)
+        cls.order.departments.set([create_department(cls.store, 'Отдел')])
+
+    def setUp(self):
+        super().setUp()
+        self.user._order_access = OrderAccess(True, frozenset(), frozenset())
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+
+    def get(self, **headers):
+        return self.api.get('/orders/', {'stores_id': self.store.id, 'published': 'true', 'successful': 'true'}, **headers)
+
+    def date_completed(self, response):
+        self.assertEqual(response.status_code, 200)
+        order, = [o for o in response.data['orders'] if o['id'] == self.order.id]
+        return order['date_completed']
+
+    def test_completed_log_reaches_cached_list(self):
+        before = self.get()
+        self.assertIsNone(self.date_completed(before))
+
+        polls = []
+        bump = orders_cache._bump
+
+        def poll_after_bump(*args):
+            bump(*args)
+            # опрос клиента сразу после смены поколения, пока остальные колбэки коммита не выполнены
+            polls.append(self.get())
+
+        with mock.patch.object(orders_cache, '_bump', poll_after_bump):
+            with self.captureOnCommitCallbacks(execute=True):
+                OrderStatusLog.objects.create(order=self.order, status_id=4)
+        self.order.refresh_from_db()
+        self.assertIsNotNone(self.order.completed_at)
+
+        poll, = polls
+        self.assertNotEqual(poll['ETag'], before['ETag'])
+        self.assertEqual(self.date_completed(poll), self.order.date_completed)
+        # следующий опрос - из кеша, с той же датой
+        self.assertEqual(self.date_completed(self.get()), self.order.date_completed)
+        # старый ETag больше не подходит, новый - подходит
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=before['ETag']).status_code, 200)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=poll['ETag']).status_code, 304)
+
+
+class SignedUpStub(BaseHTTPRequestHandler):
+    """ Сайнап на локальном порту: отвечает по очереди заданными (код, тело) и запоминает запросы """
+    responses = []
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+        self.received.append({'path': self.path, 'headers': dict(self.headers), 'data': parse_qs(body)})
+        code, text = self.responses.pop(0) if self.responses else (201, '{}')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(text.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class OutboxTest(OrdersTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), SignedUpStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.signedup_site = override_settings(SIGNEDUP_API_SITE='http://127.0.0.1:%s/' % cls.server.server_port)
+        cls.signedup_site.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.signedup_site.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('outbox')
+        store = create_store()
+        cls.order = create_test_order(store, 1, customer=Customer.objects.create(client=store.client))
+
+    def setUp(self):
+        super().setUp()
+        SignedUpStub.responses[:] = []
+        SignedUpStub.received[:] = []
+        signedup._breaker.update(failures=0, opened=None)
+
+    def publish(self, *responses):
+        """ Публикация после правки: signedup_order_text - словарь в памяти, как во views.order """
+        self.order.set_order_data({'services': [], 'fields': [], 'dates': '2030-01-01'})
+        self.order.save()
+        SignedUpStub.responses[:] = list(responses)
+        return enqueue_order_publish(self.order, self.user)
+
+    def deliver(self, outbox_id):
+        # запрос в сайнап должен идти вне транзакции доставки
+        depth = []
+        post = signedup.post
+
+        def spy(*args, **kwargs):
+            depth.append(len(connection.savepoint_ids))
+            return post(*args, **kwargs)
+
+        outer = len(connection.savepoint_ids)
+        with mock.patch.object(signedup, 'post', spy):
+            deliver_order_outbox(outbox_id)
+        self.assertTrue(all(d == outer for d in depth))
+        return OrderOutbox.objects.get(id=outbox_id)
+
+    def test_sent(self):
+        outbox = self.deliver(self.publish((201, '{}')).id)
+        self.assertEqual(outbox.status, OrderOutbox.STATUS_SENT)
+        self.assertIsNone(outbox.locked_until)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status_id, 2)
+        self.assertIsNotNone(self.order.published_at)
+
+        request, = SignedUpStub.received
+        self.assertEqual(request['path'], '/api/tasks/task/')
+        self.assertEqual(request['headers']['Idempotency-Key'], 'terminal-order-%s' % self.order.id)
+        # словарь уходит так же, как раньше уходил словарь из памяти (requests отправляет его ключи)
+        self.assertEqual(request['data']['signedup_order_text'], ['services', 'fields', 'dates'])
+        self.assertEqual(request['data']['terminal_id'], [str(self.order.id)])
+
+    def test_text_from_db(self):
+        # публикация из списка: заказ прочитан из базы, уходит текст
+        self.publish()
+        self.order.refresh_from_db()
+        outbox = enqueue_order_publish(self.order, self.user)
+        SignedUpStub.responses[:] = [(201, '{}')]
+        self.deliver(outbox.id)
+        request, = SignedUpStub.received
+        self.assertEqual(request['data']['signedup_order_text'], [self.order.signedup_order_text])
+
+    def test_final_error(self):
+        outbox = self.deliver(self.publish((400, '{"error": "Неверный город"}')).id)
+        self.assertEqual(outbox.status, OrderOutbox.STATUS_FAILED)
+        self.assertIsNone(outbox.locked_until)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status_id, 1)
+        # ошибка видна в карточке
+        card = load_order(self.order.id).card_outbox.serialize()
+        self.assertEqual(card['status'], OrderOutbox.STATUS_FAILED)
+        self.assertIn('Неверный город', card['error'])
+
+    def test_retry(self):
+        outbox = self.deliver(self.publish((503, 'unavailable')).id)
+        self.assertEqual(outbox.status, OrderOutbox.STATUS_PENDING)
+        self.assertEqual(outbox.attempts, 1)
+        self.assertIsNone(outbox.locked_until)
+        self.assertGreater(outbox.next_attempt, timezone.now())
+
+        # срок повтора не пришел - подбор зависших не трогает
+        retry_pending_outbox()
+        self.assertEqual(len(SignedUpStub.received), 1)
+
+        OrderOutbox.objects.filter(id=outbox.id).update(next_attempt=timezone.now())
+        SignedUpStub.responses[:] = [(201, '{}')]
+        retry_pending_outbox()
+        self.assertEqual(len(SignedUpStub.received), 2)
+        self.assertEqual(OrderOutbox.objects.get(id=outbox.id).status, OrderOutbox.STATUS_SENT)
+
+    def test_claimed(self):
+        outbox = self.publish((201, '{}'))
+        # запись уже отправляет другой воркер
+        OrderOutbox.objects.filter(id=outbox.id).update(locked_until=timezone.now() + datetime.timedelta(minutes=1))
+        self.deliver(outbox.id)
+        retry_pending_outbox()
+        self.assertEqual(SignedUpStub.received, [])
+        self.assertEqual(OrderOutbox.objects.get(id=outbox.id).status, OrderOutbox.STATUS_PENDING)
+
+
+class XLSJobTest(OrdersTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('xls')
+        cls.params = orders_xls_params(QueryDict('store_id=1'))
+
+    def test_long_running_job_is_reused(self):
+        xls = enqueue_orders_xls(self.user, self.params)
+        # выгрузка идет давно, но прогресс был только что
+        OrderXLS.objects.filter(id=xls.id).update(status=OrderXLS.STATUS_RUNNING,
+                                                  created=timezone.now() - datetime.timedelta(hours=3))
+        self.assertEqual(enqueue_orders_xls(self.user, self.params).id, xls.id)
+
+    def test_stale_job_is_replaced(self):
+        xls = enqueue_orders_xls(self.user, self.params)
+        OrderXLS.objects.filter(id=xls.id).update(status=OrderXLS.STATUS_RUNNING,
+                                                  heartbeat=timezone.now() - datetime.timedelta(minutes=10))
+        self.assertNotEqual(enqueue_orders_xls(self.user, self.params).id, xls.id)
+        self.assertEqual(OrderXLS.objects.get(id=xls.id).status, OrderXLS.STATUS_FAILED)
+
+
+@override_settings(ROOT_URLCONF='orders.tests', ORDERS_EVENTS_SYNC=True)
+class OrderEventsTest(TestCase):
+    """ Поток событий через тестовый клиент и настоящий Redis pub/sub """
+
+    @classmethod
+    def setUpClass(cls):
+        # нужен локальный Redis (docker-compose up redis), без него тест пропускается
+        try:
+            get_redis_connection('default').ping()
+        except Exception:
+            raise SkipTest('Redis недоступен')
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('events')
+        cls.store = create_store()
+        cls.department = create_department(cls.store, 'Отдел 1')
+        cls.other_department = create_department(cls.store, 'Отдел 2')
+        cls.order = create_test_order(cls.store, 2)
+        cls.order.departments.set([cls.department])
+        cls.other_order = create_test_order(cls.store, 2)
+        cls.other_order.departments.set([cls.other_department])
+
+    def stream(self, access):
+        # права считаются один раз на запрос и кладутся на юзера - тест задает их так же
+        self.user._order_access = access
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get('/orders/events/', {'stores_id': self.store.id}, HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.addCleanup(response.close)
+        stream = iter(response.streaming_content)
+        self.assertEqual(next(stream), b'retry: %d\n\n' % events.SSE_RETRY_MS)
+        return stream
+
+    def next_event(self, stream):
+        for chunk in stream:
+            if chunk.startswith(b'event: order\n'):
+                return json.loads(chunk.decode().split('data: ', 1)[1])
+        self.fail('Поток закончился без события')
+
+    def publish(self, order, event):
+        with self.captureOnCommitCallbacks(execute=True):
+            events.publish_order_event(order.id, event)
+
+    @mock.patch.object(events, 'SSE_KEEPALIVE', 0.1)
+    def test_status_event(self):
+        stream = self.stream(OrderAccess(True, frozenset(), frozenset()))
+        self.publish(self.order, {'type': 'status', 'status_id': 3})
+        event = self.next_event(stream)
+        self.assertEqual((event['type'], event['order_id'], event['store_id'], event['status_id']),
+                         ('status', self.order.id, self.store.id, 3))
+        self.assertNotIn('departments', event)
+
+    @mock.patch.object(events, 'SSE_KEEPALIVE', 0.1)
+    def test_departments_filter(self):
+        stream = self.stream(OrderAccess(False, frozenset([self.department.id]), frozenset([self.store.id])))
+        # заказ чужого отдела до юзера не доходит
+        self.publish(self.other_order, {'type': 'feedback'})
+        self.publish(self.order, {'type': 'feedback'})
+        self.assertEqual(self.next_event(stream)['order_id'], self.order.id)
+
+    @override_settings(ORDERS_EVENTS_SYNC=False)
+    def test_api_workers_refuse(self):
+        self.user._order_access = OrderAccess(True, frozenset(), frozenset())
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get('/orders/events/', {'stores_id': self.store.id})
+        self.assertEqual(response.status_code, 503)
@@ -1,29 +1,46 @@
 import datetime
-import math
-import os
-import requests
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
-from django.core.files.base import ContentFile
 from django.core.paginator import Paginator
-from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import transaction
+from django.db.models import Exists, OuterRef, prefetch_related_objects
+from django.utils import timezone
 
+from django_q.tasks import async_task
 from pytils.dt import ru_strftime
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from rest_framework import status, serializers, permissions
-from rest_framework.decorators import permission_classes
-from xlsxwriter.workbook import Workbook
+from rest_framework.decorators import permission_classes, renderer_classes
+from rest_framework.renderers import JSONRenderer
 
-from api.models import Contractor
 from clients.models import *
 from orders.models import *
+from orders import signedup
+from orders.cache import (bump_orders, bump_stores, get_orders_view, not_modified, order_card_etag, orders_view_admin_etag,
+                          orders_view_cache_key, orders_view_etag, set_orders_view)
+from orders.card import load_order
+from orders.events import EventStreamRenderer, events_worker, order_events_stream, publish_order_events
+from orders.catalog import catalog_version, get_catalog, set_catalog
+from orders.builder import create_order, load_custom_fields, load_services, sync_order_fields, sync_order_lines
+from orders.outbox import enqueue_order_publish
+from orders.payload import PayloadError, parse_fields, parse_services
+from orders.permissions import OrderAccess
+from orders.signals import order_signals_suppressed
+from orders.pagination import approximate_count, cursor_page
+from orders.xls import enqueue_orders_xls, export_orders_xls, fail_stale_xls_job, orders_xls_params
 from services.models import *
 from api.models import Log
 from api.utils import str_to_bool, phone_format, send_sms as send_sms_process
 from aidu.views.views_schedule import check_available_slots
 
+# Параллельных запросов в сайнап при пакетной смене статуса
+ORDERS_STATUS_WORKERS = getattr(settings, 'ORDERS_STATUS_WORKERS', 8)
+
 
 class ImageSerializer(serializers.Serializer):
     image = serializers.FileField(required=True)
@@ -31,28 +48,27 @@ class ImageSerializer(serializers.Serializer):
 
 def user_has_access_to_order(user, order):
     """ Юзер должен быть прикреплен к отделу (для КМ - 0, СМ - 1, АО - 2) или магазину (для АМ - 3, АСМ - 4) """
-    if user.is_terminal_man:
-        return True
-    user_departments = user.departments
-    for d in order.departments.all():
-        if d in user_departments:
-            return True
-    return False
-
-
-def user_has_access_to_store(user, store_id, user_store_id=None, user_stores=None):
-    if user.is_terminal_man:
-        return True
-    if user.is_acm or user.is_com:
-        if user_stores:
-            return store_id in user_stores
-        else:
-            store = ClientStore.objects.filter(id=store_id).first()
-            return store in user.stores
-    else:
-        if user_store_id:
-            return str(store_id) == str(user_store_id)
-        return str(store_id) == str(user.store.id)
+    return OrderAccess.for_user(user).has_order(order)
+
+
+def user_has_access_to_store(user, store_id):
+    return OrderAccess.for_user(user).has_store(store_id)
+
+
+def orders_cursor_response(request, orders, count, descending, is_admin):
+    """ Список заказов с пагинацией по курсору (?cursor=), ?with_total=true - примерное общее количество """
+    try:
+        objects, next_cursor, prev_cursor = cursor_page(orders, request.query_params.get('cursor'), count, descending)
+    except ValueError:
+        return Response({'error': 'Неверный курсор'}, status=status.HTTP_400_BAD_REQUEST)
+    data = {
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+        'orders': Order.serialize_many(objects, is_admin=is_admin, with_address=True)
+    }
+    if str_to_bool(request.query_params.get('with_total')):
+        data['total_approx'] = approximate_count(orders)
+    return Response(data, status=status.HTTP_200_OK)
 
 
 # СПИСОК ЗАКАЗОВ ДЛЯ АДМИНИСТРАТОРА ТЕРМИНАЛА
@@ -62,6 +78,18 @@ def orders_view_admin(request):
     if not request.user.is_terminal_man:
         return Response(status=status.HTTP_403_FORBIDDEN)
 
+    # пока заказы не менялись, клиенту хватает 304 по ETag
+    etag = orders_view_admin_etag(request.query_params)
+    if not_modified(request, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    response = orders_view_admin_list(request)
+    if response.status_code == status.HTTP_200_OK:
+        response['ETag'] = etag
+    return response
+
+
+def orders_view_admin_list(request):
+    """ Страница списка заказов для администратора терминала (orders_view_admin) """
     page = request.query_params.get('page')
     page = int(page) if page else 1
 
@@ -77,7 +105,10 @@ def orders_view_admin(request):
     else:
         orders = orders.exclude(store__city__country_title='Казахстан')
 
-    orders_data = orders.prefetch_related('departments').select_related('status').select_related('store').order_by(order_by).distinct()
+    orders = orders.prefetch_related('departments').select_related('status', 'store__client', 'store__city')
+    if 'cursor' in request.query_params:
+        return orders_cursor_response(request, orders, 50, order_sort == 'desc', is_admin=True)
+    orders_data = orders.order_by(order_by)
 
     p = Paginator(orders_data, 50)
     try:
@@ -85,18 +116,47 @@ def orders_view_admin(request):
         objects = page_now.object_list
     except:
         objects = []
-    feedbacks = Feedback.objects.filter(order__in=objects)
-    orders_list = []
-    addresses = OrderCustomFieldValue.objects.filter(custom_field__field_name='address', order__in=objects)
-    for o in objects:
-        order = o.serialize(is_admin=True, feedbacks=feedbacks)
-        address = ''
-        for a in addresses:
-            if a.order_id == o.id:
-                address = a.value
-                break
-        order['address'] = address
-        orders_list.append(order)
+    orders_list = Order.serialize_many(objects, is_admin=True, with_address=True)
+    data = {
+        'current_page': page,
+        'total_pages': p.num_pages,
+        'orders': orders_list
+    }
+    return Response(data, status=status.HTTP_200_OK)
+
+
+def orders_view_list(request, access, stores_id):
+    """ Страница списка заказов магазинов (orders_view GET), без кеша """
+    published = str_to_bool(request.query_params.get('published')) if 'published' in request.query_params else False
+
+    page = request.query_params.get('page')
+    page = int(page) if page else None
+    count = request.query_params.get('count')
+    count = int(count) if count else 50
+    successful = str_to_bool(request.query_params.get('successful'))
+
+    # доступ по отделам через EXISTS, без join и DISTINCT
+    orders = Order.objects.filter(store_id__in=stores_id).filter(access.orders_filter())
+    if published:
+        if successful:
+            orders = orders.filter(status_id__in=[2, 3, 4, 7])
+        else:
+            orders = orders.filter(status_id__in=[5, 6])
+    else:
+        orders = orders.filter(status_id=1)
+    orders = orders.prefetch_related('departments').select_related('status', 'store__client', 'store__city')
+    if 'cursor' in request.query_params:
+        return orders_cursor_response(request, orders, count, True, is_admin=False)
+    orders = orders.order_by('-id')
+
+    p = Paginator(orders, count)
+    try:
+        page_now = p.page(page)
+        objects = page_now.object_list
+    except:
+        objects = []
+    orders_list = Order.serialize_many(objects, is_admin=False, with_address=True)
+
     data = {
         'current_page': page,
         'total_pages': p.num_pages,
@@ -118,53 +178,20 @@ def orders_view(request):
             if not user_has_access_to_store(request.user, store_id):
                 return Response(status=status.HTTP_403_FORBIDDEN)
 
-        published = str_to_bool(request.query_params.get('published')) if 'published' in request.query_params else False
-
-        page = request.query_params.get('page')
-        page = int(page) if page else None
-        count = request.query_params.get('count')
-        count = int(count) if count else 50
-        successful = str_to_bool(request.query_params.get('successful'))
-
-        user = request.user
-        user_departments_id = [d.id for d in user.departments]
-
-        orders = Order.objects.filter(store_id__in=stores_id, departments__id__in=user_departments_id)
-        if published:
-            if successful:
-                orders = orders.filter(status_id__in=[2, 3, 4, 7])
-            else:
-                orders = orders.filter(status_id__in=[5, 6])
-        else:
-            orders = orders.filter(status_id=1)
-        orders = orders.prefetch_related('departments').select_related('status').select_related('store').order_by('-id').distinct()
-
-        p = Paginator(orders, count)
-        try:
-            page_now = p.page(page)
-            objects = page_now.object_list
-        except:
-            objects = []
-        feedbacks = Feedback.objects.filter(order__in=objects)
-
-        orders_list = []
-        addresses = OrderCustomFieldValue.objects.filter(custom_field__field_name='address', order__in=objects)
-        for o in objects:
-            order = o.serialize(is_admin=False, feedbacks=feedbacks)
-            address = ''
-            for a in addresses:
-                if a.order_id == o.id:
-                    address = a.value
-                    break
-            order['address'] = address
-            orders_list.append(order)
-
-        data = {
-            'current_page': page,
-            'total_pages': p.num_pages,
-            'orders': orders_list
-        }
-        return Response(data, status=status.HTTP_200_OK)
+        # повторные опросы с теми же параметрами - из кеша, пока заказы магазинов не менялись
+        access = OrderAccess.for_user(request.user)
+        cache_key = orders_view_cache_key(access, request.query_params, stores_id)
+        etag = orders_view_etag(cache_key)
+        if not_modified(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        data = get_orders_view(cache_key)
+        if data is not None:
+            return Response(data, status=status.HTTP_200_OK, headers={'ETag': etag})
+        response = orders_view_list(request, access, stores_id)
+        if response.status_code == status.HTTP_200_OK:
+            set_orders_view(cache_key, response.data)
+            response['ETag'] = etag
+        return response
 
     if request.method == 'POST':
         user = request.user
@@ -181,326 +208,169 @@ def orders_view(request):
         return send_order_to_signedup(o, user)
 
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+def orders_events(request):
+    """
+    Поток событий заказов магазинов (SSE, text/event-stream): ?stores_id=1,2.
+    Событие: {"type": "status" | "feedback", "order_id", "store_id", "status_id", "at"}.
+    Отдается только сервисом terminal-events (gevent), воркеры API отвечают 503
+    """
+    if not events_worker():
+        return Response({'error': 'Поток событий обслуживает отдельный сервис'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    stores_id = [i for i in (request.query_params.get('stores_id') or '').split(',') if i]
+    if not stores_id:
+        return Response({'error': 'Не выбран магазин'}, status=status.HTTP_400_BAD_REQUEST)
+    for store_id in stores_id:
+        if not user_has_access_to_store(request.user, store_id):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+    response = StreamingHttpResponse(order_events_stream(stores_id, OrderAccess.for_user(request.user)),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx не должен буферизовать поток
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def orders_delete(request):
     if request.method == 'POST':
-        # проверяем, что юзер имеет доступ
-        orders_id = request.GET.get('orders_id')
-        orders = Order.objects.filter(
-            id__in=[int(i) for i in orders_id.split(',')])
-        for order in orders:
-            if not user_has_access_to_order(request.user, order):
-                pass
-            else:
-                order.delete()
-        return Response(status=status.HTTP_200_OK)
+        orders_id = [int(i) for i in request.GET.get('orders_id').split(',')]
+        # проверяем, что юзер имеет доступ - одним запросом
+        orders = OrderAccess.for_user(request.user).filter_orders(Order.objects.filter(id__in=orders_id))
+        with transaction.atomic():
+            deleted_stores = dict(orders.values_list('id', 'store_id'))
+            deleted = list(deleted_stores)
+            images = [name for name in FeedbackImage.objects.filter(feedback__order_id__in=deleted).exclude(
+                image='').exclude(image=None).values_list('image', flat=True)]
+            # каскад (логи, инвойсы, поля, черновики, отзывы...) удаляется пачками по таблицам
+            with order_signals_suppressed():
+                Order.objects.filter(id__in=deleted).delete()
+            bump_stores(deleted_stores.values(), deleted)
+            if images:
+                transaction.on_commit(lambda: async_task('orders.tasks.delete_feedback_images', images))
+        deleted_set = set(deleted)
+        refused = [i for i in orders_id if i not in deleted_set]
+        return Response({'deleted': deleted, 'refused': refused}, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def orders_xls2(request):
     if request.method == 'GET':
-        user = request.user
-
         if request.user.is_terminal_coworker:
             return Response(status=status.HTTP_403_FORBIDDEN)
 
-        orders_id = request.GET.get('orders_id', '')
-        departments_id = request.GET.get('departments_id', '')
-        store_id = request.GET.get('store_id', '')
-        client_id = request.GET.get('client_id', '')
-        date_to = request.GET.get('date_to')
-        date_from = request.GET.get('date_from')
-        contractor_id = request.GET.get('contractor_id')
-
-        is_client_price = str_to_bool(request.GET.get('is_client_price'))
-        is_aggregator_price = str_to_bool(
-            request.GET.get('is_aggregator_price'))
-        is_executor_fio = str_to_bool(request.GET.get('is_executor_fio'))
-
-        is_contractor_name = str_to_bool(request.GET.get('is_contractor_name'))
-        is_contractor_price = str_to_bool(
-            request.GET.get('is_contractor_price'))
-
-        is_concatenate_services = str_to_bool(request.query_params.get(
-            'is_concatenate_services')) if 'is_concatenate_services' in request.query_params else True
-
-        orders = Order.objects.filter(status_id=4)
-        if orders_id:
-            orders = orders.filter(id__in=[int(i)
-                                   for i in orders_id.split(',')])
-        if departments_id:
-            orders = orders.filter(departments__id__in=[
-                                   int(i) for i in departments_id.split(',')])
-        if store_id:
-            orders = orders.filter(
-                store_id__in=[int(i) for i in store_id.split(',')])
-        if client_id:
-            orders = orders.filter(store__client_id__in=[
-                                   int(i) for i in client_id.split(',')])
-        if date_to:
-            orders = orders.filter(completed_time__date__lte=date_to)
-        if date_from:
-            orders = orders.filter(completed_time__date__gte=date_from)
-        if not user.is_terminal_man:
-            orders = orders.filter(store__in=user.stores)
-        orders = orders.select_related('status').select_related(
-            'store').prefetch_related('departments').order_by('id').distinct()
-
-        custom_fields_headers = []
-        if contractor_id:
-            orders_ids = [oi.order_id for oi in OrderInvoice.objects.filter(
-                Q(contractor_id=contractor_id) | Q(contractor_id=None))]
-            orders = [o for o in orders if o.id in orders_ids]
-        else:
-            c_id = None
-            if client_id:
-                c_id = client_id
-            else:
-                if len(orders) > 0:
-                    c_id = orders[0].store.client_id
-            if c_id:
-                custom_fields = OrderCustomField.objects.filter(
-                    client_id=c_id, show_in_xls=True).order_by('-index_number')
-                for cf in custom_fields:
-                    custom_fields_headers.append(
-                        {'id': cf.id, 'title': cf.label})
-
-        random_hash = secrets.token_hex(4)
-        fname = 'orders_%s_%s.xlsx' % (str(datetime.date.today()), random_hash)
-        os.makedirs("orders_xls", exist_ok=True)
-        if user.is_terminal_man:
-            fn = 'orders_xls/%s/%s' % (user.id, fname)
-            os.makedirs("orders_xls/%s" % user.id, exist_ok=True)
-        else:
-            fn = 'orders_xls/%s/%s' % (user.client.id, fname)
-            os.makedirs("orders_xls/%s" % user.client.id, exist_ok=True)
-        workbook = Workbook(fn)
-        worksheet = workbook.add_worksheet()
-        bold_left = workbook.add_format({'bold': True, 'align': 'left'})
-
-        columns = ['ID заказа', 'Город', 'Торговая точка', 'Отдел',
-                   'Сотрудник, опубликовавший заказ', 'Перечень услуг в заказе']
-        if is_client_price:
-            columns += ['Суммарная стоимость услуг по цене для клиента']
-        if is_aggregator_price:
-            columns += ['Суммарная стоимость услуг по цене для AIDU']
-
-        if is_contractor_name:
-            columns += ['Имя подрядчика']
-        if is_contractor_price:
-            columns += ['Суммарная стоимость услуг по цене для подрядчика']
-
-        if len(custom_fields_headers) > 0:
-            for cf in custom_fields_headers:
-                columns += [cf['title']]
-
-        columns += ['Отзыв']
-        if is_executor_fio:
-            columns += ['Исполнитель']
-        columns += [
-            'Статус заказа',  'Дата создания заказа',
-            'Дата публикации заказа', 'Нашли исполнителя', 'Закрыли заказ']
-
-        for i, val in enumerate(columns):
-            worksheet.write(0, i, val, bold_left)
-
-        data = []
-
-        invoices = OrderInvoice.objects.filter(order__in=orders).select_related(
-            'contractor').select_related('service')
-        aggregator = Contractor.objects.filter(is_aggregator=True).first()
-        aggregator_id = aggregator.id
-
-        if is_concatenate_services:
-            for order in orders:
-                order_invoices = [
-                    i for i in invoices if i.order_id == order.id]
-                contractors = list(
-                    set([i.contractor.title for i in order_invoices if i.contractor]))
-                if len(contractors) == 0:
-                    contractors = [aggregator.title]
-                contractor_title = ', '.join(contractors)
-                cost_contractor = order.price(
-                    invoices=order_invoices, contractor=True, aggregator_id=aggregator_id)
-                departments = ', '.join(
-                    [d.title for d in order.departments.all()])
-                f = order.feedback_obj
-                feedback_rate = ''
-                executor_fio = ''
-                if f:
-                    try:
-                        feedback_rate = round(
-                            (f.adequacy + f.decency + f.punctuality) / 3, 1)
-                    except:
-                        pass
-                    executor_fio = f.executor_fio
-
-                order_data = [
-                    order.id, order.store.city.title, order.store.title, departments,
-                    order.publish_fio, order.signedup_order_text_for_xls(),
-                ]
-                if is_client_price:
-                    price = float(order.cost)
-                    order_data += [price]
-                if is_aggregator_price:
-                    cost_signedup = order.price(
-                        invoices=order_invoices, signedup=True, aggregator_id=aggregator_id)
-                    order_data += [cost_signedup]
-
-                if is_contractor_name:
-                    order_data += [contractor_title]
-                if is_contractor_price:
-                    order_data += [round(cost_contractor + 0.01)]
-
-                if len(custom_fields_headers) > 0:
-                    for cf in custom_fields_headers:
-                        cf_value = OrderCustomFieldValue.objects.filter(
-                            order_id=order.id, custom_field_id=cf['id']).first()
-                        if cf_value:
-                            order_data += [cf_value.value]
-                        else:
-                            order_data += ['']
-
-                order_data += [feedback_rate]
-                if is_executor_fio:
-                    order_data += [executor_fio]
-
-                order_data += [
-                    order.status.title, order.date.strftime('%Y-%m-%d %H:%M'),
-                    order.publish_date.strftime(
-                        '%Y-%m-%d %H:%M'), order.date_find_executor, order.date_completed
-                ]
-                data.append(order_data)
+        params = orders_xls_params(request.query_params)
+        if str_to_bool(request.query_params.get('async')):
+            # выгрузка в фоне, прогресс и ссылку на файл отдает orders_xls_status
+            xls = enqueue_orders_xls(request.user, params)
+            return Response(xls.serialize(), status=status.HTTP_202_ACCEPTED)
 
-        else:
-            for order in orders:
-                order_invoices = [
-                    i for i in invoices if i.order_id == order.id]
-                services = [oi.service for oi in order_invoices]
-
-                contractors = list(
-                    set([i.contractor.title for i in order_invoices if i.contractor]))
-                if len(contractors) == 0:
-                    contractors = [aggregator.title]
-                contractor_title = ', '.join(contractors)
-                for order_invoice in order_invoices:
-                    if order_invoice.contractor_id == aggregator.id:
-                        cost_contractor = 0
-                    else:
-                        cost_contractor = round(float(order_invoice.get_cost(
-                            services, order_invoice.cost_contractor)) + 0.01) if order_invoice.cost_contractor else ''
-                    departments = order_invoice.department.title
-                    f = order.feedback_obj
-                    feedback_rate = ''
-                    executor_fio = ''
-                    if f:
-                        try:
-                            feedback_rate = round(
-                                (f.adequacy + f.decency + f.punctuality) / 3, 1)
-                        except:
-                            pass
-                        executor_fio = f.executor_fio
-
-                    order_data = [
-                        order.id, order.store.city.title, order.store.title, departments,
-                        order.publish_fio, order.signedup_order_text_for_xls(
-                            invoice=order_invoice),
-                    ]
-                    if is_client_price:
-                        price = float(order_invoice.get_cost(
-                            services, order_invoice.cost)) if order_invoice.cost else ''
-                        order_data += [price]
-                    if is_aggregator_price:
-                        cost_signedup = float(order_invoice.get_cost(
-                            services, order_invoice.cost_signedup)) if order_invoice.cost_signedup else ''
-                        order_data += [cost_signedup]
-
-                    if is_contractor_name:
-                        order_data += [contractor_title]
-                    if is_contractor_price:
-                        order_data += [cost_contractor]
-
-                    if len(custom_fields_headers) > 0:
-                        for cf in custom_fields_headers:
-                            cf_value = OrderCustomFieldValue.objects.filter(order_id=order.id,
-                                                                            custom_field_id=cf['id']).first()
-                            if cf_value:
-                                order_data += [cf_value.value]
-                            else:
-                                order_data += ['']
-
-                    order_data += [feedback_rate]
-                    if is_executor_fio:
-                        order_data += [executor_fio]
-
-                    order_data += [
-                        order.status.title, order.date.strftime(
-                            '%Y-%m-%d %H:%M'),
-                        order.publish_date.strftime(
-                            '%Y-%m-%d %H:%M'), order.date_find_executor, order.date_completed
-                    ]
-                    for i in range(int(order_invoice.count)):
-                        data.append(order_data)
-
-        for row_num, row_data in enumerate(data):
-            for col_num, col_data in enumerate(row_data):
-                worksheet.write(row_num+1, col_num, col_data)
-        workbook.close()
-
-        with open(fn, "rb") as fh:
-            with ContentFile(fh.read()) as file_content:
-                xls = OrderXLS.objects.create(ids=orders_id, file_type='orders_xls')
-                xls.file.save(fname, file_content)
-                xls.save()
+        xls = export_orders_xls(request.user, params)
         return Response({'link': xls.file_url}, status=status.HTTP_200_OK)
 
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def orders_xls_status(request, xls_id):
+    try:
+        xls = OrderXLS.objects.get(id=xls_id)
+    except OrderXLS.DoesNotExist:
+        return Response({'error': 'Выгрузка не найдена'}, status=status.HTTP_404_NOT_FOUND)
+    if not request.user.is_terminal_man and xls.user_id != request.user.id:
+        return Response(status=status.HTTP_403_FORBIDDEN)
+    # зависшая выгрузка отдается ошибкой, чтобы клиент не ждал ее бесконечно
+    return Response(fail_stale_xls_job(xls).serialize(), status=status.HTTP_200_OK)
+
+
+def _freeze(value):
+    """ Хешируемый ключ значения: равные (==) сериализации услуг дают равные ключи """
+    if isinstance(value, dict):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def unique_services(services):
+    """ Убирает одинаковые услуги, оставляя последнее вхождение (как раньше сравнение попарно) """
+    seen = set()
+    result = []
+    for k in reversed(services):
+        key = _freeze(k)
+        if key not in seen:
+            seen.add(key)
+            result.append(k)
+    result.reverse()
+    return result
+
+
 def services_struct(all_services_objects, user, order=None, invoices=None):
+    """
+    Услуги, сгруппированные по отделам. Число запросов не зависит от числа услуг:
+    отделы услуг и магазины подгружаются одним prefetch, отделы магазина - по разу на магазин
+    """
     department_data = {}
-    services_by_department = []
-    for service, service_serialize in all_services_objects:
-        if order and order.publish:
-            dep = ClientStoreDepartment.objects.get(
-                id=service_serialize.get('oi_department_id'))
-            if dep in department_data:
-                department_data[dep].append(service_serialize)
+    departments = {}
+
+    def add(dep, service_serialize):
+        departments[dep.id] = dep
+        department_data.setdefault(dep.id, []).append(service_serialize)
+
+    if order and order.publish:
+        # опубликованный заказ - услуги по отделам строк заказа
+        deps = ClientStoreDepartment.objects.in_bulk(
+            {s.get('oi_department_id') for _, s in all_services_objects if s.get('oi_department_id')})
+        for service, service_serialize in all_services_objects:
+            dep = deps.get(service_serialize.get('oi_department_id'))
+            if dep:
+                add(dep, service_serialize)
+    else:
+        services = [service for service, _ in all_services_objects]
+        prefetch_related_objects(services, 'store', 'departments')
+        all_store_departments = user.is_terminal_man or user.is_am or user.is_acm
+        store_departments = {}
+        employee_departments = set()
+        if not all_store_departments:
+            employee_departments = set(ClientStoreDepartment.objects.filter(employees=user).values_list('id', flat=True))
+
+        for service, service_serialize in all_services_objects:
+            service_departments = service.departments.all()
+            if all_store_departments:
+                if service.store_id not in store_departments:
+                    store_departments[service.store_id] = list(service.store.departments())
+                depts = store_departments[service.store_id]
             else:
-                department_data[dep] = [service_serialize]
-        else:
-            if user.is_terminal_man:
-                depts = []
-                for d in service.store.departments():
-                    depts.append(d)
+                depts = [d for d in service_departments if d.id in employee_departments]
+
+            if not order:
+                service_department_ids = {d.id for d in service_departments}
+                for dep in depts:
+                    if dep.id in service_department_ids:
+                        add(dep, service_serialize)
             else:
-                if user.is_am or user.is_acm:
-                    depts = []
-                    for d in service.store.departments():
-                        depts.append(d)
-                else:
-                    depts = service.departments.filter(employees__in=[user])
-
-            for dep in depts:
-                if not order:
-                    if dep in service.departments.all():
-                        if dep in department_data:
-                            department_data[dep].append(service_serialize)
-                        else:
-                            department_data[dep] = [service_serialize]
-                else:
+                for dep in depts:
                     if service_serialize.get('oi_department_id') == dep.id:
                         service_serialize.pop('oi_id')
                         service_serialize.pop('oi_department_id')
-                        if dep in department_data:
-                            department_data[dep].append(service_serialize)
-                        else:
-                            department_data[dep] = [service_serialize]
-
-    for dep, services in department_data.items():
-        services = [k for j, k in enumerate(
-            services) if k not in services[j + 1:]]
+                        add(dep, service_serialize)
+                        break
+
+    services_by_department = []
+    for dep_id, services in department_data.items():
+        services = unique_services(services)
         services.sort(key=lambda item: item.get('discount_type') or '')
+        dep = departments[dep_id]
         d = {
             'department_title': dep.title,
             'department_id': dep.id,
@@ -519,19 +389,34 @@ def orders_new(request):
         if not user_has_access_to_store(request.user, request.query_params.get('store_id')):
             return Response(status=status.HTTP_403_FORBIDDEN)
 
+        department_id = request.query_params.get('department_id')
+        if department_id:
+            try:
+                if not OrderAccess.for_user(user).has_department(department_id):
+                    return Response(status=status.HTTP_403_FORBIDDEN)
+            except ValueError:
+                return Response({'error': 'Отдел не найден'}, status=status.HTTP_400_BAD_REQUEST)
+
         if request.user.is_acm or request.user.is_com:
-            store = ClientStore.objects.filter(id=request.query_params.get('store_id')).first()
+            store_id = request.query_params.get('store_id')
+            store = None
         else:
             store = user.store
+            store_id = store.id
+
+        # каталог магазина меняется редко: при попадании в кеш база не нужна
+        data = get_catalog(store_id, user, department_id)
+        if data is not None:
+            return Response(data, status=status.HTTP_200_OK)
+
+        if store is None:
+            store = ClientStore.objects.filter(id=store_id).first()
 
-        department_id = request.query_params.get('department_id')
         if department_id:
             try:
                 department = ClientStoreDepartment.objects.get(id=department_id)
             except:
                 return Response({'error': 'Отдел не найден'}, status=status.HTTP_400_BAD_REQUEST)
-            if department not in user.departments:
-                return Response(status=status.HTTP_403_FORBIDDEN)
             services = department.services()
         else:
             services = store.services(user=request.user)
@@ -555,6 +440,7 @@ def orders_new(request):
             'fields': fields,
             'city_id': store.city.city_id
         }
+        set_catalog(store_id, user, department_id, data)
         return Response(data, status=status.HTTP_200_OK)
 
     if request.method == 'POST':
@@ -583,12 +469,18 @@ def orders_new(request):
             if day.date() < datetime.datetime.now().date() + datetime.timedelta(days=60):
                 dates_clean.append(date)
 
-        services = []
-        services_data = eval(request.data['services'])
-        for service in services_data:
-            service_id = service.get('id')
-            service = Service.objects.get(id=service_id)
-            services.append(service)
+        try:
+            services_data = parse_services(request.data.get('services'))
+            fields = parse_fields(request.data.get('fields'))
+        except PayloadError as e:
+            return Response({'error': 'Неверные данные заказа: %s' % e}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            services = load_services(services_data)
+            custom_fields = load_custom_fields(fields)
+        except Service.DoesNotExist:
+            return Response({'error': 'Услуга не найдена'}, status=status.HTTP_400_BAD_REQUEST)
+        except OrderCustomField.DoesNotExist:
+            return Response({'error': 'Поле заказа не найдено'}, status=status.HTTP_400_BAD_REQUEST)
 
         if len(dates_clean) > 0 and not check_available_slots(dates_clean, services, store.city.city_id):
             ru_dates = []
@@ -599,35 +491,10 @@ def orders_new(request):
         
         phone = request.data.get('phone')
         send_sms = str_to_bool(request.data.get('send_sms'))
-        customer, _ = Customer.objects.get_or_create(phone=phone_format(phone), client=user.client)
-        o = Order.objects.create(phone=phone, status_id=1, send_sms=send_sms, store=store, customer=customer)
-        OrderStatusLog.objects.create(order=o, status_id=1)
-
-        for service in services_data:
-            service_id = service.get('id')
-            department_id = service.get('department_id')
-            count = service.get('count')
-            service = Service.objects.get(id=service_id)
-            if service.service_type_id == 1:
-                cost = service.cost
-                cost_signedup = service.cost_signedup
-            else:
-                cost = None
-                cost_signedup = None
-            OrderInvoice.objects.create(count=count, service=service, order=o, cost=cost, title=service.title,
-                                        department_id=department_id, cost_signedup=cost_signedup)
-            o.departments.add(int(department_id))
-
-        fields = eval(request.data['fields'])
-        for field in fields:
-            custom_field_id = field.get('id')
-            value = field.get('value')
-            OrderCustomFieldValue.objects.create(value=value, custom_field_id=custom_field_id, order=o)
-        OrderDraft.objects.create(order=o, employee=user)
-
-        o.signedup_order_text = o.get_signedup_order_text(dates=dates)
-        o.cost = o.price()
-        o.save()
+        with transaction.atomic():
+            customer, _ = Customer.objects.get_or_create(phone=phone_format(phone), client=user.client)
+            # строки, значения полей и отделы пачками; текст и цену считаем по объектам в памяти
+            o = create_order(store, customer, user, phone, send_sms, dates, services_data, services, fields, custom_fields)
         if o.send_sms:
             send_sms_process(o.phone, 'Ваша заявка №%s. Служба поддержки https://vk.cc/cqDT0M' % o.id)
         return Response({'id': o.id}, status=status.HTTP_201_CREATED)
@@ -639,7 +506,17 @@ def order(request, order_id):
     if request.method == 'GET':
         user = request.user
 
-        o = Order.objects.get(id=order_id)
+        # ETag по версии заказа: для неизменного заказа - 304 до загрузки карточки
+        access = OrderAccess.for_user(user)
+        etag = None
+        store_id = access.filter_orders(Order.objects.filter(id=order_id)).values_list('store_id', flat=True).first()
+        if store_id is not None and access.has_store(store_id):
+            etag = order_card_etag(access, order_id, catalog_version())
+            if not_modified(request, etag):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        # все данные карточки - за фиксированное число запросов
+        o = load_order(order_id)
         if not user.is_terminal_man:
             if not user_has_access_to_order(user, o):
                 return Response(status=status.HTTP_403_FORBIDDEN)
@@ -652,8 +529,7 @@ def order(request, order_id):
 
         services_primary = []
         services_discount = []
-        invoices = OrderInvoice.objects.filter(
-            order=o).select_related('service')
+        invoices = o.card_invoices
         all_services_objects = []
         for oi in invoices:
             service = oi.service
@@ -666,8 +542,7 @@ def order(request, order_id):
             if service.service_type_id == 2:
                 services_discount.append(service_serialize)
             all_services_objects.append([service, service_serialize])
-        fields = [field_value.custom_field.serialize(field_value) for field_value in OrderCustomFieldValue.objects.filter(
-            order=o).order_by('custom_field__index_number')]
+        fields = [field_value.custom_field.serialize(field_value) for field_value in o.card_field_values]
 
         # 1. показываем все услуги для данного магазина (Service)
         # 2. показываем все поля для заполнения в заказе (OrderCustomField)
@@ -679,8 +554,9 @@ def order(request, order_id):
         order_data = {'id': o.id, 'date': o.date, 'fio': o.fio, 'publish_fio': o.publish_fio, 'status': o.status.title,
                       'phone': o.phone, 'departments': departments, 'send_sms': o.send_sms, 'cost': float(o.cost) if o.cost else None,
                       'client_id': client.id, 'client_title': client.title}
-        logs = OrderStatusLog.objects.filter(order=o)
-        order_data.update({'logs': [l.serialize() for l in logs]})
+        order_data.update({'logs': [l.serialize() for l in o.card_logs]})
+        # публикация идет фоновой задачей: ожидание, отправка или ошибка сайнапа
+        order_data['signedup_publish'] = o.card_outbox.serialize() if o.card_outbox else None
 
         data = {
             'services': services_struct(all_services_objects, user, order=o, invoices=invoices),
@@ -690,7 +566,7 @@ def order(request, order_id):
             'dates': o.dates,
             'executor_id': o.executor_id
         }
-        return Response(data, status=status.HTTP_200_OK)
+        return Response(data, status=status.HTTP_200_OK, headers={'ETag': etag} if etag else None)
 
     if request.method == 'POST':
         user = request.user
@@ -715,69 +591,36 @@ def order(request, order_id):
         # if not dates:
         #     return Response({'error': 'Не выбрана дата'}, status=status.HTTP_400_BAD_REQUEST)
 
-        phone = request.data.get('phone')
-        o.phone = phone
-        o.save(need_send_sms=True)
-
-        services_data = eval(request.data['services'])
-
-        current_ids = [(int(service.get('id')), int(service.get('department_id')))
-                       for service in services_data if service.get('id')]
-        for old_oi in OrderInvoice.objects.filter(order=o):
-            if (old_oi.service_id, old_oi.department_id) not in current_ids:
-                old_oi.delete()
-        # current_ids = [int(service.get('id')) for service in services_data if service.get('id')]
-        # OrderInvoice.objects.filter(order=o).exclude(service_id__in=current_ids).delete()
-
-        for service in services_data:
-            service_id = service.get('id')
-            count = service.get('count')
-            department_id = service.get('department_id')
-            service = Service.objects.get(id=service_id)
-            if service.service_type_id == 1:
-                cost = service.cost
-                cost_signedup = service.cost_signedup
-            else:
-                cost = None
-                cost_signedup = None
-
-            oi = OrderInvoice.objects.filter(
-                service_id=service_id, order=o, department_id=department_id).first()
-            if not oi:
-                OrderInvoice.objects.create(count=count, service=service, order=o, cost=cost, title=service.title,
-                                            department_id=department_id, cost_signedup=cost_signedup)
-            else:
-                OrderInvoice.objects.filter(service_id=service_id, order=o, department_id=department_id).update(
-                    count=count, cost=cost, cost_signedup=cost_signedup)
-
-            o.departments.add(int(department_id))
-
-        fields = eval(request.data['fields'])
-        current_ids = [int(field.get('id'))
-                       for field in fields if field.get('id')]
-        OrderCustomFieldValue.objects.filter(order=o).exclude(
-            custom_field_id__in=current_ids).delete()
-        for field in fields:
-            custom_field_id = field.get('id')
-            value = field.get('value')
-            cf = OrderCustomFieldValue.objects.filter(
-                custom_field_id=custom_field_id, order=o).first()
-            if not cf:
-                OrderCustomFieldValue.objects.create(
-                    value=value, custom_field_id=custom_field_id, order=o)
-            else:
-                OrderCustomFieldValue.objects.filter(
-                    custom_field_id=custom_field_id, order=o).update(value=value)
-
-        o.signedup_order_text = o.get_signedup_order_text(dates=dates)
-        o.cost = o.price()
-        o.save()
-
-        if str_to_bool(request.data.get('published')):
-            return send_order_to_signedup(o, user)
-        else:
+        # данные проверяются до первой записи в заказ
+        try:
+            services_data = parse_services(request.data.get('services'))
+            fields = parse_fields(request.data.get('fields'))
+        except PayloadError as e:
+            return Response({'error': 'Неверные данные заказа: %s' % e}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            services = load_services(services_data)
+            custom_fields = load_custom_fields(fields)
+        except Service.DoesNotExist:
+            return Response({'error': 'Услуга не найдена'}, status=status.HTTP_400_BAD_REQUEST)
+        except OrderCustomField.DoesNotExist:
+            return Response({'error': 'Поле заказа не найдено'}, status=status.HTTP_400_BAD_REQUEST)
+
+        o.phone = request.data.get('phone')
+
+        # разница с сохраненным заказом считается в памяти и применяется пачками; вся правка
+        # (телефон, строки, поля, черновик или очередь публикации) - одна транзакция
+        with transaction.atomic():
+            invoices = sync_order_lines(o, services_data, services)
+            field_values = sync_order_fields(o, fields, custom_fields)
+
+            o.set_order_data(o.get_signedup_order_text(dates=dates, invoices=invoices, field_values=field_values))
+            o.cost = o.price(invoices=invoices)
+            o.save(need_send_sms=True)
+
+            if str_to_bool(request.data.get('published')):
+                return send_order_to_signedup(o, user)
             OrderDraft.objects.create(order=o, employee=user)
-            return Response({'id': o.id}, status=status.HTTP_200_OK)
+        return Response({'id': o.id}, status=status.HTTP_200_OK)
 
 
 @api_view(['GET', 'POST'])
@@ -848,112 +691,92 @@ def feedback(request, order_id):
 
 
 def send_order_to_signedup(o, user):
-    client = user.client
-
-    client_percents = o.store.client.contractors_percent
-    if client_percents:
-        client_percents = float(client_percents)
-
-    data = {
-        'client_percents': client_percents,
-        'signedup_order_text': o.signedup_order_text,
-        'signedup_account_api_key': settings.TERMINAL_API_KEY,
-        'title': 'Корпоративный заказ от %s' % o.store.client.title,
-        'subcategory_titles': o.subcategory_titles,
-        'phone': o.phone,
-        'client_name': client.title if client else None,
-        'client_logo': client.get_logo_content() if client else '',
-        'client_type': client.client_type if client else '',
-        'terminal_id': o.id,
-        'city_id': o.store.city.city_id,
-        'customer': o.customer.id
-    }
-    if o.store.contractor_id:
-        data['prefered_contractor_id'] = o.store.contractor_id
-    r = requests.post(settings.SIGNEDUP_API_SITE + 'api/tasks/task/', data=data)
-    if r.status_code == 201:
-        o.signedup_task_id = r.json().get('id')
-        o.status_id = 2
-        o.data_sent = data
-        o.save()
-        OrderPublish.objects.create(order=o, employee=user)
-        OrderStatusLog.objects.create(order=o, status_id=2)
-        return Response({'id': o.id}, status=status.HTTP_200_OK)
-    else:
-        Log.objects.create(
-            category='orders', function='order to signedup', title=r.text, text=data)
-        if r.json().get('already_exist'):
-            o.status_id = 2
-            o.data_sent = data
-            o.save()
-            OrderPublish.objects.create(order=o, employee=user)
-            OrderStatusLog.objects.create(order=o, status_id=2)
-            return Response({'id': o.id}, status=status.HTTP_200_OK)
-        return Response({'error': 'signed up error'}, status=status.HTTP_400_BAD_REQUEST)
+    """ Заказ уходит в сайнап фоновой задачей с повторами, статус 2 он получит после успешной отправки """
+    enqueue_order_publish(o, user)
+    return Response({'id': o.id, 'queued': True}, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def orders_search(request):
-    ''' ПОИСК ЗАКАЗОВ ПО ВСЕМ ПОЛЯМ '''
+    ''' ПОИСК ОПУБЛИКОВАННЫХ ЗАКАЗОВ ПО ТЕЛЕФОНУ И КАСТОМНЫМ ПОЛЯМ '''
     if not (request.user.is_coworker or request.user.is_terminal_man):
         return Response(status=status.HTTP_403_FORBIDDEN)
 
-    search = request.query_params.get('search')
-    c = request.query_params.get('c', 1)
-
-    orders_id = [op.order_id for op in list(
-        OrderPublish.objects.all().select_related('order')) * c]
-    orders = Order.objects.filter(
-        id__in=orders_id).prefetch_related('departments')
-
-    data = []
+    search = request.query_params.get('search') or ''
+    page = request.query_params.get('page')
+    count = request.query_params.get('count')
+    count = int(count) if count else 50
+
+    results = OrderSearchIndex.objects.filter(
+        Exists(OrderPublish.objects.filter(order_id=OuterRef('order_id'))))
+    access = OrderAccess.for_user(request.user)
+    if not access.is_terminal_man:
+        results = results.filter(access.orders_filter(outer_ref='order_id'))
+    if search:
+        # подстрока и префикс через триграммный индекс, выше - более похожие
+        results = results.filter(text__icontains=search).annotate(
+            rank=TrigramSimilarity('text', search)).order_by('-rank', '-order_id')
+    else:
+        results = results.order_by('-order_id')
+    results = results.select_related('order')
 
-    for order in orders:
-        if request.user.is_terminal_man:
-            has_access = True
-        else:
-            has_access = user_has_access_to_order(request.user, order)
+    if not page:
+        return Response(Order.serialize_many([r.order for r in results]), status=status.HTTP_200_OK)
 
-        if has_access:
-            if search in order.phone:
-                data.append(order.serialize())
-                continue
+    page = int(page)
+    p = Paginator(results, count)
+    try:
+        objects = p.page(page).object_list
+    except:
+        objects = []
+    data = {
+        'current_page': page,
+        'total_pages': p.num_pages,
+        'orders': Order.serialize_many([r.order for r in objects])
+    }
+    return Response(data, status=status.HTTP_200_OK)
 
-            fields = order.eval_fields
-            for v in fields:
-                if search == v.get('field_value') or search in v.get('field_value'):
-                    data.append(order.serialize())
-                    break
 
-    return Response(data, status=status.HTTP_200_OK)
+def signedup_change_status(order_id: int, status_id: int):
+    """ Смена статуса Спец.Заказа в сайнапе. Возвращает текст ошибки сайнапа или None """
+    data = {
+        'signedup_account_api_key': settings.TERMINAL_API_KEY,
+        'order_id': order_id,
+        'status_id': status_id
+    }
+    r = signedup.post('api/specialtasks/status/', data)
+    if r.status_code != 200:
+        try:
+            return r.json()['error']
+        except:
+            return r.text
+    return None
 
 
 def change_status_in_signedup(order: Order, status_id: int) -> Response:
     """ Запрос в сайнап, где меняем статус Спец.Заказа. В случае успеха - меням статус и в Терминале """
     try:
-        data = {
-            'signedup_account_api_key': settings.TERMINAL_API_KEY,
-            'order_id': order.id,
-            'status_id': status_id
-        }
-        r = requests.post(settings.SIGNEDUP_API_SITE +
-                          'api/specialtasks/status/', data=data)
-        if r.status_code != 200:
-            try:
-                error = r.json()['error']
-            except:
-                error = r.text
+        error = signedup_change_status(order.id, status_id)
+        if error is not None:
             return Response({'error': error}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         old_status = order.status_id
+        now = timezone.now()
         if old_status not in [5, 6]:
             order.status_id = status_id
-            order.save()
-            OrderStatusLog.objects.create(order=order, status_id=status_id)
+            if status_id == 4 and order.completed_at is None:
+                order.completed_at = now
+        if status_id in [5, 6]:
+            order.completed_at = None
+        order.save()
+        if old_status not in [5, 6]:
+            OrderStatusLog.objects.create(order=order, status_id=status_id, created=now)
         if status_id in [5, 6]:
             # Статус выполнения заказа, если он был в логах - удаляем.
             OrderStatusLog.objects.filter(order=order, status_id=4).delete()
         return Response(status=status.HTTP_200_OK)
+    except signedup.SignedUpUnavailable:
+        return Response({'error': 'Сайнап недоступен, попробуйте позже'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
     except:
         Log.objects.create(category='orders', function='change_status_in_signedup',
                            title='order_id=%s, status_id=%s' % (order.id, status_id), text=traceback.format_exc())
@@ -997,6 +820,78 @@ def order_fail(request, order_id):
     return change_status_in_signedup(order, 5)
 
 
+def _signedup_change_status_safe(order_id, status_id):
+    """ Для пула потоков: в потоке только запрос в сайнап, ошибки логируются уже в основном потоке """
+    try:
+        return signedup_change_status(order_id, status_id), None
+    except signedup.SignedUpUnavailable:
+        return 'Сайнап недоступен, попробуйте позже', None
+    except:
+        return 'Ошибка. Обратитесь к Администратору', traceback.format_exc()
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def orders_status_batch(request):
+    """
+    Отмена (6) или "Не выполнено" (5) для списка заказов: {'ids': [...], 'status_id': 5 | 6}.
+    Все роли, кроме КМ. Ответ - результат по каждому заказу: {id: {'ok': true} | {'error': '...'}}
+    """
+    user = request.user
+    if user.is_consult:
+        return Response({'error': 'Роль не подходит'}, status=status.HTTP_403_FORBIDDEN)
+    try:
+        status_id = int(request.data.get('status_id'))
+        ids = request.data.get('ids') or []
+        if isinstance(ids, str):
+            ids = ids.split(',')
+        ids = list(dict.fromkeys(int(i) for i in ids))
+    except (TypeError, ValueError):
+        return Response({'error': 'Неверные параметры'}, status=status.HTTP_400_BAD_REQUEST)
+    if status_id not in [5, 6] or not ids:
+        return Response({'error': 'Неверные параметры'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # права на все заказы - одним запросом
+    access = OrderAccess.for_user(user)
+    orders = {o.id: o for o in access.filter_orders(Order.objects.filter(id__in=ids))}
+    results = {order_id: {'error': 'Заказ не найден или нет доступа'} for order_id in ids if order_id not in orders}
+
+    # запросы в сайнап параллельно, не больше ORDERS_STATUS_WORKERS одновременно
+    changed = []
+    if orders:
+        with ThreadPoolExecutor(max_workers=min(ORDERS_STATUS_WORKERS, len(orders))) as pool:
+            responses = list(pool.map(lambda order_id: _signedup_change_status_safe(order_id, status_id), orders))
+        for (order_id, o), (error, tb) in zip(orders.items(), responses):
+            if tb:
+                Log.objects.create(category='orders', function='orders_status_batch',
+                                   title='order_id=%s, status_id=%s' % (order_id, status_id), text=tb)
+            if error is not None:
+                results[order_id] = {'error': error}
+            else:
+                results[order_id] = {'ok': True}
+                changed.append(o)
+
+    if changed:
+        updated = [o for o in changed if o.status_id not in [5, 6]]
+        for o in updated:
+            o.status_id = status_id
+        for o in changed:
+            o.completed_at = None
+        changed_ids = [o.id for o in changed]
+        # пакетные операции сигналы не вызывают (а удаление логов вызвало бы их на каждую строку),
+        # строки выгрузки пересобираем явно одним вызовом
+        with transaction.atomic(), order_signals_suppressed():
+            Order.objects.bulk_update(changed, ['status', 'completed_at'])
+            OrderStatusLog.objects.bulk_create([OrderStatusLog(order=o, status_id=status_id) for o in updated])
+            # Статус выполнения заказа, если он был в логах - удаляем.
+            OrderStatusLog.objects.filter(order_id__in=changed_ids, status_id=4).delete()
+            transaction.on_commit(lambda: OrderExportRow.rebuild(changed_ids))
+            bump_orders(changed_ids)
+            publish_order_events({o.id: [{'type': 'status', 'status_id': status_id}] for o in updated})
+
+    return Response({str(order_id): results[order_id] for order_id in ids}, status=status.HTTP_200_OK)
+
+
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def executor_assign(request):
@@ -1013,7 +908,7 @@ def executor_assign(request):
             'order_id': order.id,
             'executor_phone': executor_phone
         }
-        r = requests.post(settings.SIGNEDUP_API_SITE + 'api/specialtasks/executor-assign/', data=data)
+        r = signedup.post('api/specialtasks/executor-assign/', data)
         if r.status_code != 200:
             try:
                 error = r.json()['error']
@@ -1023,9 +918,12 @@ def executor_assign(request):
 
         # Если у заказа не было исполнителя - исполнитель назначается, меняется статус заказа
         if order.status_id == 2:
+            now = timezone.now()
             order.status_id = 3
+            if order.executor_found_at is None:
+                order.executor_found_at = now
+            OrderStatusLog.objects.create(order=order, status_id=3, created=now)
             order.save()
-            OrderStatusLog.objects.create(order=order, status_id=3)
 
         cf, created = Feedback.objects.get_or_create(order_id=order.id)
         if created:
@@ -1038,6 +936,8 @@ def executor_assign(request):
         cf.save()
 
         return Response(status=status.HTTP_200_OK)
+    except signedup.SignedUpUnavailable:
+        return Response({'error': 'Сайнап недоступен, попробуйте позже'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
     except:
         Log.objects.create(category='orders', function='executor_assign',
                            title='order_id=%s, executor_phone=%s' % (order.id, executor_phone), text=traceback.format_exc())
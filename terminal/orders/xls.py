@@ -0,0 +1,306 @@
+import datetime
+import hashlib
+import json
+import os
+import secrets
+import tempfile
+
+from django.core.files import File
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django_q.tasks import async_task
+from xlsxwriter.workbook import Workbook
+
+from api.models import Contractor
+from api.utils import str_to_bool
+from orders.pricing import invoices_costs, load_discounts, orders_prices
+from orders.models import Order, OrderInvoice, OrderCustomField, OrderCustomFieldValue, OrderExportRow, OrderXLS
+
+# Сколько заказов за раз читаем из базы при выгрузке
+XLS_CHUNK_SIZE = 500
+# Фоновая выгрузка считается зависшей (и не мешает запустить такую же заново), если давно не было прогресса:
+# в работе - пачки заказов, в очереди - запуска. Долгая выгрузка, которая двигается, зависшей не считается
+XLS_HEARTBEAT_TIMEOUT = datetime.timedelta(minutes=5)
+XLS_QUEUE_TIMEOUT = datetime.timedelta(minutes=30)
+
+
+def xls_date(value):
+    # даты заказа могут быть пустыми: заказ без черновика или публикации
+    return value.strftime('%Y-%m-%d %H:%M') if value else ''
+
+
+def xls_job_stale(xls):
+    if xls.status not in OrderXLS.ACTIVE_STATUSES:
+        return False
+    timeout = XLS_HEARTBEAT_TIMEOUT if xls.status == OrderXLS.STATUS_RUNNING else XLS_QUEUE_TIMEOUT
+    return xls.heartbeat < timezone.now() - timeout
+
+
+def fail_stale_xls_job(xls):
+    """ Зависшая выгрузка помечается ошибкой; если она успела подать признак жизни - остается как есть """
+    if xls_job_stale(xls) and OrderXLS.objects.filter(id=xls.id, status=xls.status, heartbeat=xls.heartbeat).update(
+            status=OrderXLS.STATUS_FAILED):
+        xls.status = OrderXLS.STATUS_FAILED
+    return xls
+
+
+def orders_xls_params(query_params):
+    """ Параметры выгрузки заказов из GET-запроса """
+    return {
+        'orders_id': query_params.get('orders_id', ''),
+        'departments_id': query_params.get('departments_id', ''),
+        'store_id': query_params.get('store_id', ''),
+        'client_id': query_params.get('client_id', ''),
+        'date_to': query_params.get('date_to'),
+        'date_from': query_params.get('date_from'),
+        'contractor_id': query_params.get('contractor_id'),
+        'is_client_price': str_to_bool(query_params.get('is_client_price')),
+        'is_aggregator_price': str_to_bool(query_params.get('is_aggregator_price')),
+        'is_executor_fio': str_to_bool(query_params.get('is_executor_fio')),
+        'is_contractor_name': str_to_bool(query_params.get('is_contractor_name')),
+        'is_contractor_price': str_to_bool(query_params.get('is_contractor_price')),
+        'is_concatenate_services': str_to_bool(query_params.get(
+            'is_concatenate_services')) if 'is_concatenate_services' in query_params else True,
+    }
+
+
+def orders_xls_queryset(user, params):
+    """ Выполненные заказы для выгрузки и заголовки кастомных полей клиента """
+    orders = Order.objects.filter(status_id=4)
+    if params['orders_id']:
+        orders = orders.filter(id__in=[int(i) for i in params['orders_id'].split(',')])
+    if params['departments_id']:
+        orders = orders.filter(departments__id__in=[int(i) for i in params['departments_id'].split(',')])
+    if params['store_id']:
+        orders = orders.filter(store_id__in=[int(i) for i in params['store_id'].split(',')])
+    if params['client_id']:
+        orders = orders.filter(store__client_id__in=[int(i) for i in params['client_id'].split(',')])
+    if params['date_to']:
+        orders = orders.filter(completed_time__date__lte=params['date_to'])
+    if params['date_from']:
+        orders = orders.filter(completed_time__date__gte=params['date_from'])
+    if not user.is_terminal_man:
+        orders = orders.filter(store__in=user.stores)
+    orders = orders.select_related('status', 'store__city').prefetch_related('departments').order_by('id').distinct()
+
+    custom_fields_headers = []
+    if params['contractor_id']:
+        orders = orders.filter(id__in=OrderInvoice.objects.filter(
+            Q(contractor_id=params['contractor_id']) | Q(contractor_id=None)).values('order_id'))
+    else:
+        c_id = None
+        if params['client_id']:
+            c_id = params['client_id']
+        else:
+            first_order = orders.first()
+            if first_order:
+                c_id = first_order.store.client_id
+        if c_id:
+            custom_fields = OrderCustomField.objects.filter(client_id=c_id, show_in_xls=True).order_by('-index_number')
+            for cf in custom_fields:
+                custom_fields_headers.append({'id': cf.id, 'title': cf.label})
+    return orders, custom_fields_headers
+
+
+def orders_xls_columns(params, custom_fields_headers):
+    columns = ['ID заказа', 'Город', 'Торговая точка', 'Отдел',
+               'Сотрудник, опубликовавший заказ', 'Перечень услуг в заказе']
+    if params['is_client_price']:
+        columns += ['Суммарная стоимость услуг по цене для клиента']
+    if params['is_aggregator_price']:
+        columns += ['Суммарная стоимость услуг по цене для AIDU']
+
+    if params['is_contractor_name']:
+        columns += ['Имя подрядчика']
+    if params['is_contractor_price']:
+        columns += ['Суммарная стоимость услуг по цене для подрядчика']
+
+    for cf in custom_fields_headers:
+        columns += [cf['title']]
+
+    columns += ['Отзыв']
+    if params['is_executor_fio']:
+        columns += ['Исполнитель']
+    columns += [
+        'Статус заказа', 'Дата создания заказа',
+        'Дата публикации заказа', 'Нашли исполнителя', 'Закрыли заказ']
+    return columns
+
+
+def orders_chunks(orders, chunk_size=XLS_CHUNK_SIZE):
+    """ Заказы пачками по id (keyset), чтобы не держать в памяти всю выборку """
+    last_id = 0
+    while True:
+        chunk = list(orders.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+        yield chunk
+        last_id = chunk[-1].id
+
+
+def _invoices_costs(services, values, discounts):
+    """ Цены строк заказа со скидками (как OrderInvoice.get_cost), для пустых цен - '' """
+    costs = iter(invoices_costs([(services, v) for v in values if v], discounts))
+    return [next(costs) if v else '' for v in values]
+
+
+def orders_xls_rows(orders, params, custom_fields_headers, progress=None):
+    """ Строки выгрузки по одной, в порядке id заказа. progress(n) вызывается после каждой пачки заказов """
+    aggregator = Contractor.objects.filter(is_aggregator=True).first()
+    aggregator_id = aggregator.id
+    cf_ids = [cf['id'] for cf in custom_fields_headers]
+
+    for chunk in orders_chunks(orders):
+        chunk_ids = [o.id for o in chunk]
+        invoices = {}
+        for oi in OrderInvoice.objects.filter(order_id__in=chunk_ids).select_related(
+                'contractor', 'service', 'department'):
+            invoices.setdefault(oi.order_id, []).append(oi)
+        cf_values = {}
+        if cf_ids:
+            for v in OrderCustomFieldValue.objects.filter(order_id__in=chunk_ids, custom_field_id__in=cf_ids).order_by('id'):
+                cf_values.setdefault((v.order_id, v.custom_field_id), v.value)
+
+        # готовые строки выгрузки, недостающие собираем и сохраняем
+        export_rows = {r.order_id: r for r in OrderExportRow.objects.filter(order_id__in=chunk_ids)}
+        missing = [order_id for order_id in chunk_ids if order_id not in export_rows]
+        if missing:
+            export_rows.update(OrderExportRow.rebuild(missing))
+
+        # цены считаются сразу для всей пачки, скидки берутся из кеша правил
+        discounts = load_discounts(oi.service_id for order_invoices in invoices.values() for oi in order_invoices)
+        chunk_invoices = [invoices.get(order_id, []) for order_id in chunk_ids]
+        signedup_prices = {}
+        contractor_prices = {}
+        if params['is_concatenate_services']:
+            if params['is_aggregator_price']:
+                signedup_prices = dict(zip(chunk_ids, orders_prices(
+                    chunk_invoices, signedup=True, aggregator_id=aggregator_id, discounts=discounts)))
+            if params['is_contractor_price']:
+                contractor_prices = dict(zip(chunk_ids, orders_prices(
+                    chunk_invoices, contractor=True, aggregator_id=aggregator_id, discounts=discounts)))
+
+        for order in chunk:
+            order_invoices = invoices.get(order.id, [])
+            contractors = list(set([i.contractor.title for i in order_invoices if i.contractor]))
+            if len(contractors) == 0:
+                contractors = [aggregator.title]
+            contractor_title = ', '.join(contractors)
+
+            row = export_rows[order.id]
+            tail = [cf_values.get((order.id, cf_id), '') for cf_id in cf_ids]
+            tail += [row.feedback_rate if row.feedback_rate is not None else '']
+            if params['is_executor_fio']:
+                tail += [row.executor_fio]
+            tail += [
+                order.status.title, xls_date(row.date), xls_date(row.publish_date), row.date_find_executor,
+                row.date_completed
+            ]
+
+            if params['is_concatenate_services']:
+                departments = ', '.join([d.title for d in order.departments.all()])
+                order_data = [
+                    order.id, order.store.city.title, order.store.title, departments,
+                    row.publish_fio, row.services_text,
+                ]
+                if params['is_client_price']:
+                    order_data += [float(order.cost)]
+                if params['is_aggregator_price']:
+                    order_data += [signedup_prices[order.id]]
+                if params['is_contractor_name']:
+                    order_data += [contractor_title]
+                if params['is_contractor_price']:
+                    order_data += [round(contractor_prices[order.id] + 0.01)]
+                yield order_data + tail
+            else:
+                services = [oi.service for oi in order_invoices]
+                costs = _invoices_costs(services, [oi.cost for oi in order_invoices], discounts)
+                costs_signedup = _invoices_costs(services, [oi.cost_signedup for oi in order_invoices], discounts)
+                costs_contractor = _invoices_costs(services, [oi.cost_contractor for oi in order_invoices], discounts)
+                for i, order_invoice in enumerate(order_invoices):
+                    if order_invoice.contractor_id == aggregator.id:
+                        cost_contractor = 0
+                    else:
+                        cost_contractor = round(costs_contractor[i] + 0.01) if order_invoice.cost_contractor else ''
+                    order_data = [
+                        order.id, order.store.city.title, order.store.title, order_invoice.department.title,
+                        row.publish_fio, order_invoice.title,
+                    ]
+                    if params['is_client_price']:
+                        order_data += [costs[i]]
+                    if params['is_aggregator_price']:
+                        order_data += [costs_signedup[i]]
+                    if params['is_contractor_name']:
+                        order_data += [contractor_title]
+                    if params['is_contractor_price']:
+                        order_data += [cost_contractor]
+                    for _ in range(int(order_invoice.count)):
+                        yield order_data + tail
+
+        if progress:
+            progress(len(chunk))
+
+
+def export_orders_xls(user, params, xls=None):
+    """
+    Выгрузка заказов в xlsx: строки пишутся по мере чтения из базы (constant_memory),
+    готовый файл загружается в хранилище потоком, без чтения целиком в память.
+    Если передан xls (фоновая выгрузка), в нем обновляется прогресс
+    """
+    orders, custom_fields_headers = orders_xls_queryset(user, params)
+    fname = 'orders_%s_%s.xlsx' % (str(datetime.date.today()), secrets.token_hex(4))
+
+    if xls:
+        xls.rows_total = orders.count()
+        xls.rows_done = 0
+        xls.heartbeat = timezone.now()
+        OrderXLS.objects.filter(id=xls.id).update(status=OrderXLS.STATUS_RUNNING, rows_total=xls.rows_total, rows_done=0,
+                                                  heartbeat=xls.heartbeat)
+    progress = xls.progress if xls else None
+
+    fd, fn = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        workbook = Workbook(fn, {'constant_memory': True})
+        worksheet = workbook.add_worksheet()
+        bold_left = workbook.add_format({'bold': True, 'align': 'left'})
+        for i, val in enumerate(orders_xls_columns(params, custom_fields_headers)):
+            worksheet.write(0, i, val, bold_left)
+        for row_num, row_data in enumerate(orders_xls_rows(orders, params, custom_fields_headers, progress)):
+            worksheet.write_row(row_num + 1, 0, row_data)
+        workbook.close()
+
+        with open(fn, 'rb') as fh:
+            if not xls:
+                xls = OrderXLS.objects.create(ids=params['orders_id'], file_type='orders_xls')
+            else:
+                # загрузка файла в хранилище - тоже работа, отмечаемся перед ней
+                xls.progress(0)
+            xls.status = OrderXLS.STATUS_DONE
+            xls.file.save(fname, File(fh))
+    finally:
+        os.remove(fn)
+    return xls
+
+
+def enqueue_orders_xls(user, params):
+    """
+    Ставит выгрузку в очередь django-q. Если такая же выгрузка этого юзера еще формируется,
+    возвращается она, а не создается новая
+    """
+    params_hash = hashlib.sha256(json.dumps({'user_id': user.id, 'params': params}, sort_keys=True).encode()).hexdigest()
+    active = OrderXLS.objects.filter(params_hash=params_hash, status__in=OrderXLS.ACTIVE_STATUSES).first()
+    if active and fail_stale_xls_job(active).status != OrderXLS.STATUS_FAILED:
+        return active
+
+    try:
+        with transaction.atomic():
+            xls = OrderXLS.objects.create(ids=params['orders_id'], file_type='orders_xls', user=user,
+                                          status=OrderXLS.STATUS_PENDING, params=json.dumps(params),
+                                          params_hash=params_hash)
+    except IntegrityError:
+        # такую же выгрузку параллельно поставил другой запрос
+        return OrderXLS.objects.filter(params_hash=params_hash).order_by('-id').first()
+    transaction.on_commit(lambda: async_task('orders.tasks.orders_xls_export', xls.id))
+    return xls